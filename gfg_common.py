@@ -3,59 +3,178 @@
 
 import sys
 import os
-from pathlib import Path
+import functools
+import hashlib
 import re
+from typing import TYPE_CHECKING, NamedTuple, Optional
 
-GIT_CHECKSUM_SIZE_BYTES = 20
+if TYPE_CHECKING:
+    # `typing.Final` is only available in Python >= 3.8, hence the string
+    # annotations below (these are not evaluated at runtime).
+    from typing import Final
+
+GIT_CHECKSUM_SIZE_BYTES: "Final[int]" = 20
 # See https://git-scm.com/docs/index-format#_cache_tree
-GIT_INVALID_ENTRY_COUNT = -1
+GIT_INVALID_ENTRY_COUNT: "Final[int]" = -1
 # Number of ASCII characters in GIT_INVALID_ENTRY_COUNT
-GIT_NUM_OF_ASCII_CHARS_INVALID_EC = 2
+GIT_NUM_OF_ASCII_CHARS_INVALID_EC: "Final[int]" = 2
+
+# The global Git config file. This is resolved once, when the module is
+# imported, so changes to $HOME after that are not picked up (that's fine for
+# a command line tool).
+_GLOBAL_GITCONFIG: "Final[str]" = os.path.expanduser("~/.gitconfig")
+
+# Matches the `name = <value>` and `email = <value>` entries in Git config
+# files. The whole file is scanned by the regex engine in one go.
+_RE_NAME_OR_EMAIL = re.compile(
+        rb'^[ \t]*(name|email)[ \t]*=[ \t]*(.*?)[ \t]*\r?$', re.MULTILINE)
+
+class Identity(NamedTuple):
+    """ The name and the e-mail of a committer (or an author) """
+    name: Optional[str]
+    email: Optional[str]
 
 class GFGError(Exception):
-    """ Just a small convienience class representing an exception in GFG """
+    """ Just a small convienience class representing an exception in GFG
+
+    The context of the error (e.g. the offending path) is stored alongside
+    the error description and the message is only put together when printed.
+    """
+
+    def __init__(self, code, path=None, detail=None):
+        super().__init__(code, path, detail)
+        # A short description of the error
+        self.code = code
+        # The path (or object hash) that the error relates to
+        self.path = path
+        # Any additional information (e.g. the underlying exception)
+        self.detail = detail
+
+    def __str__(self):
+        message = str(self.code)
+        if self.path is not None:
+            message += f": {self.path}"
+        if self.detail is not None:
+            message += f" ({self.detail})"
+        return message
+
+def get_blob_hash(file_path):
+    """ Calculate the Git object name (SHA-1) of a file stored as a blob
+
+    The object name is the SHA-1 of "blob <size>\\0<contents>". The contents
+    are streamed through the hash, i.e. the file is neither held in memory
+    nor decoded.
+
+    INPUT:
+        file_path - path of the file to hash
+    RETURN:
+        The SHA-1 of the corresponding blob (raw bytes, see `bytes.hex()`)
+    """
+    with open(file_path, "rb") as input_file:
+        blob_hash = hashlib.sha1(
+                b"blob %d\0" % os.fstat(input_file.fileno()).st_size)
+        if hasattr(hashlib, "file_digest"):
+            # Python >= 3.11: let hashlib drive the reads (with its own
+            # buffer and without holding the GIL for the hashing)
+            blob_hash = hashlib.file_digest(input_file, lambda: blob_hash)
+        else:
+            for chunk in iter(lambda: input_file.read(1 << 20), b''):
+                blob_hash.update(chunk)
+
+    return blob_hash.digest()
+
+@functools.lru_cache(maxsize=8)
+def _parse_config_cached(gitconfig_file_path, mtime_ns, size):
+    """ Extract the committer name and e-mail from one Git config file
+
+    Results are cached. The cache key includes the modification time and the
+    size of the file, so an updated config file is re-parsed automatically.
+
+    INPUT:
+        gitconfig_file_path - path of the Git config file to read
+        mtime_ns - modification time of the config file (cache key only)
+        size - size of the config file (cache key only)
+    RETURN:
+        An Identity containing the committer name and e-mail (either can be
+        None if not present in the file)
+    RAISES:
+        GFGError if the config file cannot be read
+    """
+    # pylint: disable=unused-argument
+    name = None
+    email = None
+
+    # Read the config file and extract the name and the e-mail. Config files
+    # are small, so read the whole file in one go and let a single regex scan
+    # it (rather than iterating over it line by line in Python).
+    try:
+        with open(gitconfig_file_path, "rb") as gitconfig_file:
+            config_data = gitconfig_file.read()
+    except OSError as err:
+        raise GFGError("GFG: Cannot read", path=gitconfig_file_path,
+                detail=err) from err
+
+    # Like in Git, if a key is set more than once, the last value wins
+    for match in _RE_NAME_OR_EMAIL.finditer(config_data):
+        key, value = match.groups()
+        if key == b'name':
+            name = value.decode('utf-8', 'replace')
+        elif key == b'email':
+            email = value.decode('utf-8', 'replace')
+
+    return Identity(name, email)
+
+def _parse_config(gitconfig_file_path):
+    """ Extract the committer name and e-mail from one Git config file
+
+    INPUT:
+        gitconfig_file_path - path of the Git config file to read
+    RETURN:
+        An Identity containing the committer name and e-mail (either can be
+        None if not present in the file)
+    RAISES:
+        GFGError if the config file cannot be read
+    """
+    try:
+        statinfo = os.stat(gitconfig_file_path)
+    except OSError as err:
+        raise GFGError("GFG: Cannot read", path=gitconfig_file_path,
+                detail=err) from err
+
+    return _parse_config_cached(gitconfig_file_path, statinfo.st_mtime_ns,
+            statinfo.st_size)
 
 def get_name_and_email(repo_dir = None):
     """ Extract the committer name and e-mail
 
-    This method will check .git/config if repo_dir is not None. Otherwise, it
-    reads $HOME/.gitconfig.
+    This method will check .git/config if repo_dir is not None. Any fields
+    that are missing there (or all fields if repo_dir is None) are read from
+    $HOME/.gitconfig.
 
     INPUT:
         repo_dir - Git object hash to get the path for
     RETURN:
-        A tuple containing the committer name and e-mail
+        An Identity containing the committer name and e-mail
+    RAISES:
+        GFGError if the config file cannot be read
     """
+    # Config files to read, in order of precedence. The global config is only
+    # read if the local config (if any) doesn't provide both fields.
+    gitconfig_file_paths = []
+    if repo_dir is not None:
+        gitconfig_file_paths.append(os.path.join(repo_dir, ".git", "config"))
+    gitconfig_file_paths.append(_GLOBAL_GITCONFIG)
+
     name = None
     email = None
+    for gitconfig_file_path in gitconfig_file_paths:
+        if name is not None and email is not None:
+            break
+        config_name, config_email = _parse_config(gitconfig_file_path)
+        name = name or config_name
+        email = email or config_email
 
-    # Get file path to read
-    gitconfig_file_path = Path()
-    if repo_dir is not None:
-        gitconfig_file_path = Path(repo_dir) / ".git" / "config"
-    else:
-        gitconfig_file_path = Path.home() / ".gitconfig"
-
-    assert os.path.exists(gitconfig_file_path), "FAIL"
-
-    # Read the config file and extract the name and the e-mail
-    with open(gitconfig_file_path, "r", encoding = 'utf-8') as gitconfig_file:
-        regex_name = re.compile(r'^\s*name =')
-        regex_email = re.compile(r'^\s*email =')
-        for file_line in gitconfig_file:
-            if re.match(regex_name, file_line):
-                name = file_line.split('=')[1].lstrip().rstrip()
-            if re.match(regex_email, file_line):
-                email = file_line.split('=')[1].lstrip().rstrip()
-
-    # If reading the local config inside the current repo, make sure that that
-    # the committer name and email were actually there. If not, read the global
-    # Git config.
-    if repo_dir is not None:
-        if name is None or email is None:
-            name, email = get_name_and_email()
-
-    return name, email
+    return Identity(name, email)
 
 if __name__ == "__main__":
     sys.exit(1)
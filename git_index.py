@@ -25,59 +25,55 @@ Limitations:
     https://docs.microsoft.com/en-us/archive/msdn-magazine/2017/august/devops-git-internals-architecture-and-index-files#index-extensions
 '''
 
-import binascii
 import mmap
 import struct
 import os
 import sys
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from pprint import pprint
 
 from gfg_common import GIT_CHECKSUM_SIZE_BYTES
 from gfg_common import GIT_INVALID_ENTRY_COUNT
-from gfg_common import GIT_NUM_OF_ASCII_CHARS_INVALID_EC
 from gfg_common import GFGError
+from gfg_common import get_blob_hash
 
+# The fixed-size part of an index entry (62 bytes): ctime (s + ns), mtime (s +
+# ns), dev, ino, mode, uid, gid, size, SHA-1 (20 bytes) and flags. All numbers
+# are in network byte order [1|4]. Compiled once, see [2|3].
+_ENTRY_HEAD = struct.Struct("! 10I 20s H")
 
-def read_from_mmapped_file(mmaped_file, format_char):
-    """Reads an integer from a memory mapped file
+# The index header (12 bytes): signature, version number and number of entries
+_HEADER = struct.Struct("! 4s I I")
 
-    Reads, unpacks and returns an integer from a memory mapped file. The size
-    of the integer to read is specified via a format char (documented in [2]).
-    As per `Git index format` [1|4], all binary numbers are in network byte
-    order. As documented in [3], this translates to `!` in the format string.
+# Integers in network byte order, compiled once (see [2|3])
+_U32 = struct.Struct("!I")
+_U16 = struct.Struct("!H")
 
-    Args:
-        mmaped_file - the memory mapped file to read from
-        format_char - use this to specify the size of the integer to read (see
-            [2] for reference)
-    Returns:
-        the integer that was read
-    """
-    data_format = "! " + format_char
-    num_bytes = mmaped_file.read(struct.calcsize(data_format))
-    return struct.unpack(data_format, num_bytes)[0]
+# Index files at least this large are hashed on a worker thread while the
+# entries are being parsed (hashlib releases the GIL, the struct module
+# doesn't). For smaller files starting a thread is not worth it.
+_THREADED_CHECKSUM_MIN_SIZE = 1 << 20
 
+# Serialised index files are produced (and written) in chunks of this size
+_WRITE_CHUNK_SIZE = 1 << 16
 
-def write_to_mmapped_file(mmaped_file, data, format_char):
-    """Writes an integer into a memory mapped file
 
-    Packs and writes an integer into a memory mapped file. The size of the
-    integer to write is specified via a format char (documented in [2]).  As
-    per `Git index format` [1|4], all binary numbers are in network byte order.
-    As documented in [3], this translates to `!` in the format string.
+def _hash_index_contents(index_file):
+    """Calculate the checksum of a memory mapped index file
+
+    The contents (minus the trailing checksum) are hashed straight from the
+    mapped file - one large update() and no copy of the data.
 
     Args:
-        mmaped_file - the memory mapped file to write to
-        data - integer to write
-        format_char - use this to specify the size of the integer to write (see
-            [2] for reference)
+        index_file - the memory mapped index file to hash
+    Returns:
+        the SHA-1 of the index contents (hex string)
     """
-    data_format = "! " + format_char
-    data_packed = struct.pack(data_format, data)
-    num_bytes = mmaped_file.write(data_packed)
-    assert len(data_packed) == num_bytes, "Error"
+    with memoryview(index_file) as index_content:
+        return hashlib.sha1(
+                index_content[:-GIT_CHECKSUM_SIZE_BYTES]).hexdigest()
 
 
 class IndexFile():
@@ -90,14 +86,22 @@ class IndexFile():
     an exceptions. These are documented in the respective methods. See also the
     list of limitations documented in the module docstring.
     """
+    # pylint: disable=too-many-instance-attributes
 
     def __init__(self, filename):
         self.index_file_name = filename
         self.header = IndexHeader(None)
         self.extension_tree_cache = IndexTreeCacheExt()
 
-        # A list of index entries. Every item is a tuple: (idx, entry)
+        # A list of index entries (IndexEntry), in the order of the index file
         self.entries = []
+        # Lookup tables for index entries, keyed by the basename and by the
+        # directory of the corresponding files. These are kept in sync with
+        # `self.entries` (see `__add_to_lookup_tables`) and are rebuilt if
+        # any entry is renamed (see `__sync_lookup_tables`).
+        self.entries_by_basename = {}
+        self.entries_by_dir = {}
+        self.__path_name_changes = IndexEntry.path_name_changes
 
         # Extensions as plain bytes
         self.extensions = b''
@@ -117,9 +121,7 @@ class IndexFile():
         The checksum should always reflect the current contents of the index
         file. Use this method after updating the contents of the index file.
         """
-        self.checksum = ""
-        contents = self.print_to_bytes()
-        self.checksum = hashlib.sha1(contents).hexdigest()
+        self.checksum = self.__hash_contents()
 
     def validate(self, read_file: bool = True):
         """ Validate the contents of this IndexFile
@@ -133,19 +135,30 @@ class IndexFile():
         RETURN:
             None
         """
+        if read_file:
+            with open(self.index_file_name, "rb") as index_file_obj, \
+                    mmap.mmap(index_file_obj.fileno(), 0,
+                            prot=mmap.PROT_READ) as index_file:
+                checksum = _hash_index_contents(index_file)
+        else:
+            checksum = self.__hash_contents()
+
+        self.__validate(checksum)
+
+    def __validate(self, checksum):
+        """ Validate the contents of this IndexFile against `checksum`
+
+        INPUT:
+            checksum - the SHA-1 (hex string) of the index contents
+        RETURN:
+            None
+        """
         assert len(self.entries) == self.header.num_entries, \
             "GFG: The index header and actual " \
             "contents are inconsistent."
 
-        if read_file:
-            with open(self.index_file_name, "rb") as index_file:
-                index_content = index_file.read()[:-20]
-                assert self.checksum == hashlib.sha1(index_content).hexdigest(), \
-                    "GFG: Index file checksum is invalid"
-        else:
-            contents = self.print_to_bytes()
-            assert self.checksum == hashlib.sha1(contents).hexdigest(), \
-                "GFG: Index file checksum is invalid"
+        assert self.checksum == checksum, \
+            "GFG: Index file checksum is invalid"
 
         self.extension_tree_cache.validate()
 
@@ -158,33 +171,91 @@ class IndexFile():
         Limitations:
             * Only the tree cache extension is currently supported
         """
-        with open(self.index_file_name, "rb") as index_file_obj:
-            index_file = mmap.mmap(
-                index_file_obj.fileno(), 0, prot=mmap.PROT_READ)
-
-            # Parse header
-            self.header = IndexHeader(index_file)
+        with open(self.index_file_name, "rb") as index_file_obj, \
+                mmap.mmap(index_file_obj.fileno(), 0,
+                        prot=mmap.PROT_READ) as index_file:
+            # The file is read front to back, let the kernel know so that it
+            # can read ahead (madvise is only available in Python >= 3.8 and
+            # not on all platforms)
+            if hasattr(mmap, "MADV_SEQUENTIAL") and hasattr(mmap, "MADV_WILLNEED"):
+                index_file.madvise(mmap.MADV_SEQUENTIAL)
+                index_file.madvise(mmap.MADV_WILLNEED)
+
+            # For large files, hash the file contents (needed for validation)
+            # in parallel with the parsing below. For small files it's not
+            # worth starting a thread.
+            if index_file.size() < _THREADED_CHECKSUM_MIN_SIZE:
+                self.__parse_contents(index_file)
+                checksum = _hash_index_contents(index_file)
+            else:
+                # The pool is shut down (i.e. the hashing is finished) before
+                # the mapping is closed
+                with ThreadPoolExecutor(max_workers=1) as pool:
+                    pending_checksum = pool.submit(_hash_index_contents, index_file)
+                    self.__parse_contents(index_file)
+                    checksum = pending_checksum.result()
+
+        self.__validate(checksum)
+
+    def __parse_contents(self, index_file):
+        """Parse the header, the entries, the extensions and the checksum
 
-            # Parse index entries
-            for entry_idx in range(self.header.num_entries):
-                entry = IndexEntry()
-                entry.read(index_file, self.header.ver_num)
-                self.entries.append((entry_idx, entry))
+        INPUT:
+            index_file - the index file contents (e.g. a memory mapping)
+        """
+        # Parse header
+        self.header = IndexHeader(index_file)
+
+        # Parse index entries. Rather than reading (i.e. copying) every
+        # field out of the mmap, the entries are decoded in place. `offset`
+        # tracks the position of the next entry.
+        # The loop below runs once per entry, so bind everything it needs
+        # to locals first.
+        offset = IndexHeader.num_bytes
+        ver_num = self.header.ver_num
+        append_entry = self.entries.append
+        add_to_lookup_tables = self.__add_to_lookup_tables
+        for _ in range(self.header.num_entries):
+            entry = IndexEntry()
+            offset = entry.read(index_file, offset, ver_num)
+            append_entry(entry)
+            add_to_lookup_tables(entry)
+
+        # Parse extensions (for now we just read the bytes)
+        checksum_offset = index_file.size() - GIT_CHECKSUM_SIZE_BYTES
+        self.extensions = index_file[offset:checksum_offset]
+        self.extension_tree_cache = IndexTreeCacheExt(self.extensions)
+
+        # Parse checksum
+        self.checksum = index_file[checksum_offset:].hex()
+
+    def __sync_lookup_tables(self):
+        """Rebuild the index entry lookup tables if they might be stale
+
+        The tables are keyed by paths, so they have to be rebuilt whenever the
+        path of an index entry changes (see `IndexEntry.path_name`).
+        """
+        if self.__path_name_changes == IndexEntry.path_name_changes:
+            return
 
-            # Parse extensions (for now we just read the bytes)
-            index_len = index_file.size()
-            num_bytes_remaining = (
-                index_len - GIT_CHECKSUM_SIZE_BYTES) - index_file.tell()
-            self.extensions = index_file.read(num_bytes_remaining)
-            self.extension_tree_cache = IndexTreeCacheExt(self.extensions)
+        self.entries_by_basename = {}
+        self.entries_by_dir = {}
+        for entry in self.entries:
+            self.__add_to_lookup_tables(entry)
+        self.__path_name_changes = IndexEntry.path_name_changes
 
-            # Parse checksum
-            self.checksum = binascii.hexlify(
-                index_file.read(GIT_CHECKSUM_SIZE_BYTES)).decode("ascii")
+    def __add_to_lookup_tables(self, entry):
+        """Add `entry` to the index entry lookup tables
 
-            index_file.close()
+        The tables are keyed by raw (i.e. not decoded) paths.
 
-        self.validate()
+        INPUT:
+            entry - index entry to add
+        """
+        self.entries_by_basename.setdefault(
+                os.path.basename(entry.path_name_bytes), []).append(entry)
+        self.entries_by_dir.setdefault(
+                os.path.dirname(os.path.join(b'.', entry.path_name_bytes)), []).append(entry)
 
     def print_to_file(self, output_file=None, with_checksum=True):
         """Prints the contents of this class into a physical file
@@ -199,39 +270,117 @@ class IndexFile():
         if output_file is None:
             output_file = self.index_file_name
 
-        with open(output_file, "wb") as index_file:
-            index_file.write(self.print_to_bytes())
+        self.__write(output_file, update_checksum=False,
+                with_checksum=with_checksum)
+
+    def __write(self, output_file, update_checksum, with_checksum=True):
+        """Write this IndexFile to output_file, replacing it atomically
+
+        The contents are written piece by piece (the file object is buffered)
+        rather than materialising the whole index in memory first. To keep
+        the original file intact if that fails half-way (e.g. when packing an
+        entry), everything goes to "<output_file>.lock" first (like in Git),
+        which then replaces output_file.
+
+        INPUT:
+            output_file - the name of the output index file
+            update_checksum - re-calculate the checksum while writing?
+            with_checksum - write the checksum at the end of the file?
+        RAISES:
+            GFGError if the lock file already exists
+        """
+        lock_file_name = f"{output_file}.lock"
+        # Fails if the lock file exists, i.e. if the index is being updated
+        # by somebody else (or a previous update crashed)
+        try:
+            index_file = open(lock_file_name, "xb", buffering=_WRITE_CHUNK_SIZE)
+        except FileExistsError as err:
+            raise GFGError("GFG: Unable to create", path=lock_file_name,
+                    detail="File exists") from err
+        try:
+            with index_file:
+                if update_checksum:
+                    self.checksum = self.__hash_contents(index_file)
+                else:
+                    index_file.writelines(self.__iter_chunks())
+
+                if with_checksum:
+                    index_file.write(bytes.fromhex(self.checksum))
+        except BaseException:
+            os.remove(lock_file_name)
+            raise
 
-            if with_checksum:
-                index_file.write(binascii.unhexlify(self.checksum.encode()))
+        os.replace(lock_file_name, output_file)
 
     def print_to_bytes(self):
         """Pack this IndexFile as a bytes object"""
-        # Pack the header
-        contents = self.header.print_to_bytes()
+        # Collect all the parts first and join them at the end. Repeatedly
+        # concatenating `bytes` would copy the accumulated contents every time.
+        return b''.join(self.__iter_chunks())
+
+    def __hash_contents(self, output_file=None):
+        """Calculate the checksum of this IndexFile
+
+        The contents are packed and hashed chunk by chunk, i.e. without
+        materialising the whole index in memory.
+
+        INPUT:
+            output_file - a file object to also write the contents to
+            (optional)
+        RETURN:
+            The SHA-1 of the contents (hex string)
+        """
+        checksum = hashlib.sha1()
+        for chunk in self.__iter_chunks():
+            checksum.update(chunk)
+            if output_file is not None:
+                output_file.write(chunk)
+
+        return checksum.hexdigest()
 
-        # Pack the entries
-        for _, entry in self.entries:
-            contents += entry.print_to_bytes(self.header.ver_num)
+    def __iter_chunks(self):
+        """Pack this IndexFile piece by piece
+
+        RETURN:
+            A generator of bytes objects that, once concatenated, give the
+            contents of this IndexFile (without the checksum)
+        """
+        # Pack the header and the entries into a buffer. Hand it over every
+        # _WRITE_CHUNK_SIZE bytes or so (rather than once per entry or once
+        # for the whole index). Every chunk gets a new buffer - the consumer
+        # may hold on to the chunks (e.g. print_to_bytes joins them).
+        contents = bytearray(self.header.print_to_bytes())
+        ver_num = self.header.ver_num
+        for entry in self.entries:
+            entry.print_to_bytearray(contents, ver_num)
+            if len(contents) >= _WRITE_CHUNK_SIZE:
+                yield contents
+                contents = bytearray()
+        yield contents
 
         # Pack the extensions
         # NOTE: Add support for more extensions. Currently only tree cache is
         # supported.
-        contents += self.extension_tree_cache.print_to_bytes()
-
-        return contents
+        yield self.extension_tree_cache.print_to_bytes()
 
     def print_to_stdout(self):
         """Prints the contents of this class into stdout
 
         Goes over all fields stored in the self object and prints them into stdout in textual form.
         """
-        pprint(self.header.__dict__)
+        pprint({name: getattr(self.header, name) for name in IndexHeader.__slots__})
+
+        # The SHA-1 and the path name are stored as raw bytes - print them in
+        # textual form instead (this is the only place where the hex string
+        # is needed)
+        textual_fields = {'sha1_bytes': 'sha1', 'path_name_bytes': 'path_name'}
+        entry_fields = [textual_fields.get(name, name)
+                for name in IndexEntry.__slots__ if name != '_path_name']
 
         print(f"len(self.entries): {len(self.entries)}")
         for entry in self.entries:
             print("[entry]")
-            pprint(entry[1].__dict__)
+            pprint({name: getattr(entry, name) for name in entry_fields})
 
         print("[extensions]")
         self.extension_tree_cache.print_to_stdout()
@@ -251,22 +400,63 @@ class IndexFile():
         RETURN:
             A list of matching index entries
         """
-        file_name = file_to_retrieve
-        matching_entries = [entry for _, entry in self.entries if\
-                (entry.path_name == file_name or
-                    os.path.basename(entry.path_name) == file_name)]
+        self.__sync_lookup_tables()
+        file_name = file_to_retrieve.encode("utf-8")
+        # Both the full path and the basename must match the basename of
+        # `file_name`, so only the entries with that basename are checked.
+        candidates = self.entries_by_basename.get(os.path.basename(file_name), [])
+        matching_entries = [entry for entry in candidates if\
+                (entry.path_name_bytes == file_name or
+                    os.path.basename(entry.path_name_bytes) == file_name)]
 
         return matching_entries
 
     def add_file(self, file_path):
         """Add a new file to this index file"""
-        self.entries.append((len(self.entries) + 1, (IndexEntry(file_path))))
-        self.header.num_entries += 1
-        self.extension_tree_cache.invalidate(os.path.dirname(file_path))
+        self.add_files([file_path])
 
-        self.update_checksum()
-        self.print_to_file()
-        self.validate()
+    def add_files(self, file_paths):
+        """Add new files to this index file
+
+        All the entries are added first and the index file is then written
+        (and hashed) only once, rather than once per file.
+
+        INPUT:
+            file_paths - paths of the files to add (relative to the worktree)
+        RETURN:
+            The new index entries (in the same order as file_paths)
+        """
+        # Creating an entry means reading and hashing the corresponding file.
+        # hashlib releases the GIL (as does file I/O), so for more than one
+        # file do this on a pool of worker threads. `map` preserves the order
+        # of `file_paths`.
+        file_paths = list(file_paths)
+        if len(file_paths) > 1:
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+                new_entries = list(pool.map(IndexEntry, file_paths))
+        else:
+            new_entries = [IndexEntry(file_path) for file_path in file_paths]
+
+        invalidated_dirs = set()
+        for file_path, new_entry in zip(file_paths, new_entries):
+            self.entries.append(new_entry)
+            self.__add_to_lookup_tables(new_entry)
+            self.header.num_entries += 1
+
+            dir_path = os.path.dirname(file_path)
+            if dir_path not in invalidated_dirs:
+                invalidated_dirs.add(dir_path)
+                self.extension_tree_cache.invalidate(dir_path)
+
+        # Serialise the index only once and use the result for both the
+        # checksum and the file itself (i.e. hash the contents as they are
+        # written). Note that the checksum can't be updated incrementally -
+        # the number of entries is stored in the header, i.e. at the very
+        # beginning of the hashed data. The contents are hashed as they are
+        # written, so there's no need to re-read (and re-validate) the file.
+        self.__write(self.index_file_name, update_checksum=True)
+
+        return new_entries
 
     def get_subtrees(self, dir_path):
         """Get cache tree index entries that are sub-dirs for dir_path
@@ -278,15 +468,14 @@ class IndexFile():
             dir_path
         """
         child_entries = []
-        root = Path("./") / dir_path
+        root = os.path.normpath(dir_path)
 
         for entry in self.extension_tree_cache.entries:
-            potential_child = Path("./") / entry.path_component
-            # For potential_child = ".":
-            #   * potential_child.parent is ".", but
-            #   * potential_child.parents is [].
-            # Hence, in order to handle "./",  we need to check both.
-            if root in potential_child.parents and root == potential_child.parent:
+            potential_child = os.path.normpath(entry.path_component)
+            # "." (i.e. the top directory) is not a sub-tree of anything
+            if potential_child == '.':
+                continue
+            if (os.path.dirname(potential_child) or '.') == root:
                 child_entries.append(entry)
 
         return child_entries
@@ -297,11 +486,17 @@ class IndexFile():
         """
         dirs_to_add = set()
         dirs_to_update = set()
+        # Directories that have already been checked. Typically, many entries
+        # share the same directory and there's no need to check it again.
+        seen_dirs = set()
 
         # Go over the entries in Git Index. For every entry, identify whether the
         # corresponding dir/tree needs creating or updating.
-        for _, item in self.entries:
+        for item in self.entries:
             dir_path_tmp = os.path.dirname(item.path_name)
+            if dir_path_tmp in seen_dirs:
+                continue
+            seen_dirs.add(dir_path_tmp)
             if dir_path_tmp == '':
                 dir_path_tmp = "./"
 
@@ -314,31 +509,28 @@ class IndexFile():
             dir_paths = os.path.normpath(dir_path_tmp).split(os.sep)
 
             # Next, generate the actual sub-dirs to check.
-            paths_to_check = []
-            for idx, _ in enumerate(dir_paths):
-                if idx != 0:
-                    paths_to_check.append(os.path.join('.', *dir_paths[0:idx+1]))
-                elif len(dir_paths) != 1:
-                    paths_to_check.append(os.path.join('.', dir_paths[0]))
-                else:
-                    # Special case - dir_path_tmp is "./"
-                    paths_to_check.append('./')
+            if len(dir_paths) == 1:
+                # Special case - dir_path_tmp is "./"
+                paths_to_check = ['./']
+            else:
+                paths_to_check = ['./' + '/'.join(dir_paths[0:idx+1])
+                        for idx in range(len(dir_paths))]
 
             # Finally, go over all paths from paths_to_check and decide whether
             # they requiere adding or updating.
             for path_to_check in paths_to_check:
-                if not self.is_dir_in_index(path_to_check):
+                tree_entry = self.extension_tree_cache.get_entry(path_to_check)
+                if tree_entry is None:
                     # This tree is yet to be added.
                     dirs_to_add.add(path_to_check)
-                elif self.extension_tree_cache.get_entries_by_dirname(path_to_check)[0].entry_count\
-                        == GIT_INVALID_ENTRY_COUNT:
+                elif tree_entry.entry_count == GIT_INVALID_ENTRY_COUNT:
                     # A tree corresponding to this directory is already present in
                     # the Index, but it is out-of-date and needs updating.
                     dirs_to_update.add(path_to_check)
 
         # Extra case for "./". If there are _any_ dirs to update, then the root
         # dir for this repo also needs updating.
-        if dir_paths:
+        if self.entries:
             dirs_to_update.add("./")
 
         self.extension_tree_cache.validate()
@@ -357,12 +549,7 @@ class IndexFile():
             True if this directory is already present in the cache tree
             extension, False otherwise
         """
-
-        for item in self.extension_tree_cache.entries:
-            if item.path_component == dir_path:
-                return True
-
-        return False
+        return self.extension_tree_cache.get_entry(dir_path) is not None
 
     def get_blobs(self, dir_path):
         """ Get all blobs in dir_path """
@@ -371,29 +558,25 @@ class IndexFile():
         if dir_path == './':
             dir_path = '.'
 
-        blobs = []
-        for _, entry in self.entries:
-            file_path = os.path.join('.', entry.path_name)
-            if os.path.dirname(file_path) == dir_path:
-                blobs.append(entry)
-
-        return blobs
+        self.__sync_lookup_tables()
+        return list(self.entries_by_dir.get(dir_path.encode("utf-8"), []))
 
 
 # pylint: disable=R0903
 # Too few public methods (0/2) (too-few-public-methods)
 class IndexHeader():
     """ Represents a Git index header """
-    # 4-byte signature, b"DIRC"
-    signature = None
-    # 4-byte version number
-    ver_num = None
-    # 32-bit number of index entries, i.e. 4-byte
-    num_entries = None
+    __slots__ = ('signature', 'ver_num', 'num_entries')
+
+    # Size of the header (in bytes)
+    num_bytes = _HEADER.size
 
     def __init__(self, index_file):
-        self.signature = "DIRC"
+        # 4-byte signature, b"DIRC"
+        self.signature = b"DIRC"
+        # 4-byte version number
         self.ver_num = 2
+        # 32-bit number of index entries, i.e. 4-byte
         self.num_entries = 0
 
         if index_file is not None:
@@ -406,13 +589,7 @@ class IndexHeader():
         RETURN:
             This index header as a bytes object
         """
-        contents = self.signature.encode()
-
-        data_format = "! " + "I"
-        contents = contents + struct.pack(data_format, self.ver_num)
-        contents = contents + struct.pack(data_format, self.num_entries)
-
-        return contents
+        return _HEADER.pack(self.signature, self.ver_num, self.num_entries)
 
     def __parse(self, index_file):
         """ Parse Git index header from
@@ -420,82 +597,93 @@ class IndexHeader():
         Reads header from the input memory mapped Git index file. The header is assumed to
         be formatted as specified by the docs [1|4]. The data is saved in `self`.
 
+        The header is decoded in place (via `unpack_from`) and the file
+        position of `index_file` is not updated.
+
         INPUT:
             index_file - memory mapped Git index file to read from
         """
-        self.signature = index_file.read(4).decode("ascii")
-        assert self.signature == "DIRC", "Not a Git index file"
-
-        self.ver_num = read_from_mmapped_file(index_file, "I")
+        (self.signature, self.ver_num, self.num_entries) = \
+                _HEADER.unpack_from(index_file, 0)
+        assert self.signature == b"DIRC", "Not a Git index file"
         assert self.ver_num in {2, 3}, f"Unsupported version: {self.ver_num}"
 
-        self.num_entries = read_from_mmapped_file(index_file, "I")
-
 
 class IndexEntry():
     """ Represents a Git index entry """
     # pylint: disable=too-many-instance-attributes
 
-    # The last time a file's metadata changed
-    ctime_s = None
-    ctime_ns = None
-
-    # The last time a file's data changed
-    mtime_s = None
-    mtime_ns = None
-
-    # The ID of device containing this file
-    dev = None
-
-    # The file's inode number
-    ino = None
-
-    # 32-bit mode, split into (high to low bits)
-    mode = None
-
-    # stat(2) data
-    uid = None
-    gid = None
-    size = None
-
-    # Object name (SHA-1 ID) for the represented object. We are using
-    # SHA-1, which are 160 bits wide. That's 20 bytes.
-    sha1 = None
-
-    # A 16-bit 'flags' field split into:
-    assume_valid = 0
-    extended = 0
-    stage = (0, 0)
-    name_len = 0
-
-    # (Version 3 or later) A 16-bit field, only applicable if the
-    # "extended flag" above is 1, split into:
-    # 1-bit reserved for future
-    reserved = None
-    # 1-bit skip-worktree flag (used for sparse checkout)
-    skip_worktree = None
-    # 1-bit intent-to-add flag (used by "git add -N")
-    intent_to_add = None
-    # 13-bits unused, must be zero
-    unused = None
-
-    # Entry path name (variable length) relative to top level directory
-    # (without leading slash).
-    path_name = ""
+    # There can be a lot of index entries, so use slots rather than a
+    # per-instance __dict__
+    __slots__ = ('ctime_s', 'ctime_ns', 'mtime_s', 'mtime_ns', 'dev', 'ino',
+            'mode', 'uid', 'gid', 'size', 'sha1_bytes', 'assume_valid',
+            'extended', 'stage', 'name_len', 'reserved', 'skip_worktree',
+            'intent_to_add', 'unused', 'path_name_bytes', '_path_name')
+
+    # Number of times an entry has been renamed (i.e. `path_name` was set).
+    # IndexFile uses this to detect stale lookup tables.
+    path_name_changes = 0
 
     def __init__(self, file_path = None):
+        # The last time a file's metadata changed
+        self.ctime_s = None
+        self.ctime_ns = None
+
+        # The last time a file's data changed
+        self.mtime_s = None
+        self.mtime_ns = None
+
+        # The ID of device containing this file
+        self.dev = None
+
+        # The file's inode number
+        self.ino = None
+
+        # 32-bit mode, split into (high to low bits)
+        self.mode = None
+
+        # stat(2) data
+        self.uid = None
+        self.gid = None
+        self.size = None
+
+        # Object name (SHA-1 ID) for the represented object. We are using
+        # SHA-1, which are 160 bits wide. That's 20 bytes. This is stored as raw
+        # bytes, see the `sha1` property for the hex string.
+        self.sha1_bytes = None
+
+        # A 16-bit 'flags' field split into:
+        self.assume_valid = 0
+        self.extended = 0
+        self.stage = (0, 0)
+        self.name_len = 0
+
+        # (Version 3 or later) A 16-bit field, only applicable if the
+        # "extended flag" above is 1, split into:
+        # 1-bit reserved for future
+        self.reserved = None
+        # 1-bit skip-worktree flag (used for sparse checkout)
+        self.skip_worktree = None
+        # 1-bit intent-to-add flag (used by "git add -N")
+        self.intent_to_add = None
+        # 13-bits unused, must be zero
+        self.unused = None
+
+        # Entry path name (variable length) relative to top level directory
+        # (without leading slash). This is stored as raw bytes and only
+        # decoded on demand, see the `path_name` property.
+        self.path_name_bytes = b""
+        self._path_name = ""
+
         if file_path is None:
             return
 
         statinfo = os.stat(file_path)
 
-        self.ctime_s = int(statinfo.st_ctime)
-        self.ctime_ns = int(statinfo.st_ctime_ns % 1e9)
-
-        self.mtime_ns = int(statinfo.st_mtime_ns % 1e9)
-        self.mtime_s = int(statinfo.st_mtime)
-
-        self.dev = statinfo.st_dev
+        # Split the timestamps into seconds and nanoseconds. Integer maths
+        # only - st_ctime/st_mtime are floats and lose precision.
+        self.ctime_s, self.ctime_ns = divmod(statinfo.st_ctime_ns, 1_000_000_000)
+        self.mtime_s, self.mtime_ns = divmod(statinfo.st_mtime_ns, 1_000_000_000)
 
         # In Git's spec, inode is a 32 bit value. However, I did experience 64
         # bit inodes on e.g. MacOS. AFAIK, internally Git only cares about the
@@ -504,27 +692,48 @@ class IndexEntry():
         #
         # Also, from https://github.com/git/git/blob/main/read-cache.c#L1756-L1758
         # "dev/ino/uid/gid/size are also just tracked to the low 32 bits"
+        self.dev = statinfo.st_dev & 0xffffffff
         self.ino = statinfo.st_ino & 0xffffffff
 
         self.mode = statinfo.st_mode
 
-        self.uid = statinfo.st_uid
-        self.gid = statinfo.st_gid
-        self.size = statinfo.st_size
+        self.uid = statinfo.st_uid & 0xffffffff
+        self.gid = statinfo.st_gid & 0xffffffff
+        self.size = statinfo.st_size & 0xffffffff
 
-        with open(file_path, "r", encoding='utf-8') as input_file:
-            read_file = input_file.read()
-            read_file = f"blob {self.size}\0{read_file}"
-            self.sha1 = hashlib.sha1(read_file.encode()).hexdigest()
+        # The object name is the SHA-1 of the corresponding blob
+        self.sha1_bytes = get_blob_hash(file_path)
 
-        # A 16-bit flags field split into:
-        self.assume_valid = 0
-        self.extended = 0
-        self.stage = (0, 0)
         # Note - this assumes that file_path is relative to the worktree path
         self.name_len = len(file_path)
 
-        self.path_name = file_path
+        # Not a rename, so bypass the `path_name` setter
+        self._path_name = file_path
+        self.path_name_bytes = file_path.encode("utf-8")
+
+    @property
+    def path_name(self):
+        """ Entry path name (variable length) as a string """
+        if self._path_name is None:
+            self._path_name = self.path_name_bytes.decode("utf-8", "replace")
+        return self._path_name
+
+    @path_name.setter
+    def path_name(self, value):
+        self._path_name = value
+        self.path_name_bytes = value.encode("utf-8")
+        IndexEntry.path_name_changes += 1
+
+    @property
+    def sha1(self):
+        """ Object name (SHA-1 ID) for the represented object as a hex string """
+        if self.sha1_bytes is None:
+            return None
+        return self.sha1_bytes.hex()
+
+    @sha1.setter
+    def sha1(self, value):
+        self.sha1_bytes = None if value is None else bytes.fromhex(value)
 
     def print_to_bytes(self, ver_num):
         """Pack this index entry as a bytes object
@@ -534,86 +743,67 @@ class IndexEntry():
         RETURN:
             This index entry as a bytes object
         """
-        data_format = "! " + "I"
-
-        # The last time a file's metadata changed
-        contents = struct.pack(data_format, self.ctime_s)
-        contents += struct.pack(data_format, self.ctime_ns)
-
-        # The last time a file's data changed
-        contents += struct.pack(data_format, self.mtime_s)
-        contents += struct.pack(data_format, self.mtime_ns)
-
-        # The ID of device containing this file
-        contents += struct.pack(data_format, self.dev)
-
-        # The file's inode number
-        contents += struct.pack(data_format, self.ino)
-
-        # 32-bit mode, split into (high to low bits)
-        contents = contents + struct.pack(data_format, self.mode)
+        return bytes(self.print_to_bytearray(bytearray(), ver_num))
 
-        # stat(2) data
-        contents += struct.pack(data_format, self.uid)
-        contents += struct.pack(data_format, self.gid)
-        contents += struct.pack(data_format, self.size)
+    def print_to_bytearray(self, contents, ver_num):
+        """Pack this index entry and append it to a bytearray
 
-        # Object name (SHA-1 ID) for the represented object. We are using
-        # SHA-1, which are 160 bits wide. That's 20 bytes.
-        contents = contents + binascii.unhexlify(self.sha1.encode())
-
-        # A 16-bit 'flags' field split into (high to low bits)
-        flags = 0
-        # 1-bit assume-valid
-        flags = int(self.assume_valid) << 16
-        # 1-bit extended, must be 0 in version 2
-        flags |= int(self.extended) << 15
-        # 2-bit stage (?)
-        flags |= int(self.stage[0]) << 14
-        flags |= int(self.stage[1]) << 13
-        flags |= self.name_len
-
-        contents += struct.pack("!H", flags)
+        Use this to pack many entries into one buffer without allocating (and
+        then copying) a bytes object per entry.
 
-        # 62 bytes so far
-        len_in_b = 62
+        INPUT:
+            contents - bytearray to append this index entry to
+            ver_num
+        RETURN:
+            contents
+        """
+        entry_start = len(contents)
+
+        # A 16-bit 'flags' field split into (high to low bits):
+        #   * 1-bit assume-valid (bit 15)
+        #   * 1-bit extended, must be 0 in version 2 (bit 14)
+        #   * 2-bit stage (bits 13 and 12)
+        #   * 12-bit name length (bits 11 - 0)
+        flags = (int(self.assume_valid) << 15) | (int(self.extended) << 14) \
+                | (int(self.stage[0]) << 13) | (int(self.stage[1]) << 12) \
+                | self.name_len
+
+        # Pack the fixed-size part of the entry in one go (see `read` for the
+        # list of fields)
+        contents += _ENTRY_HEAD.pack(self.ctime_s, self.ctime_ns,
+            self.mtime_s, self.mtime_ns, self.dev, self.ino, self.mode,
+            self.uid, self.gid, self.size,
+            self.sha1_bytes, flags)
 
         # (Version 3 or later) A 16-bit field, only applicable if the
         # "extended flag" above is 1, split into (high to low bits).
         if self.extended and (ver_num >= 3):
-            extra_flags = 0
-            # 1-bit reserved for future
-            extra_flags |= int(self.reserved) << 16
-            # 1-bit skip-worktree flag (used for sparse checkout)
-            extra_flags |= int(self.skip_worktree) << 15
-            # 1-bit intent-to-add flag (used by "git add -N")
-            extra_flags |= int(self.intent_to_add) << 14
-
-            contents += struct.pack("!H", extra_flags)
+            #   * 1-bit reserved for future (bit 15)
+            #   * 1-bit skip-worktree flag, used for sparse checkout (bit 14)
+            #   * 1-bit intent-to-add flag, used by "git add -N" (bit 13)
+            #   * 13-bits unused, must be zero
+            extra_flags = (int(bool(self.reserved)) << 15) \
+                    | (int(bool(self.skip_worktree)) << 14) \
+                    | (int(bool(self.intent_to_add)) << 13)
 
-            len_in_b += 2
+            contents += _U16.pack(extra_flags)
 
         # Entry path name (variable length) relative to top level directory
         # (without leading slash).
         assert ver_num != 4, "Writing self path name for `Version 4` not yet implemented."
-        contents += self.path_name.encode("utf-8")
-        len_in_b += len(self.path_name)
+        contents += self.path_name_bytes
 
         # 1-8 nul bytes as necessary to pad the self to a multiple of
         # eight bytes while keeping the name NUL-terminated.  (Version 4)
         # In version 4, the padding after the pathname does not exist.
         if ver_num != 4:
+            len_in_b = len(contents) - entry_start
             pad_len_b = (8 - (len_in_b % 8)) or 8
-            num_written_null_bytes = 0
-            for _ in range(pad_len_b):
-                data_packed = struct.pack('B', 0)
-                contents += data_packed
-                num_written_null_bytes += len(data_packed)
-            assert num_written_null_bytes == pad_len_b, "Error, failed to write padded bits"
+            contents += bytes(pad_len_b)
 
         return contents
 
-    def read(self, index_file, ver_num):
+    def read(self, index_file, offset, ver_num):
         """Read Git index entry from a file
 
         Reads index from the input memory mapped Git index file. The entry is
@@ -621,90 +811,99 @@ class IndexEntry():
         saved in `self`.  Note that the format was extended in Version 3 and
         then further in Version 4.
 
+        The entry is decoded in place (via `unpack_from` and slicing) and the
+        file position of `index_file` is not updated.
+
         Args:
-            index_file - memory mapped Git index file to read from
+            index_file - memory mapped Git index file to read from (any object
+                supporting the buffer protocol will do)
+            offset - offset (in bytes) of this entry within `index_file`
             ver_num - version number for the this index file (available in index header)
+        Returns:
+            the offset of the first byte after this entry
         """
-        # The last time a file's metadata changed
-        self.ctime_s = read_from_mmapped_file(index_file, "I")
-        self.ctime_ns = read_from_mmapped_file(index_file, "I")
-
-        # The last time a file's data changed
-        self.mtime_s = read_from_mmapped_file(index_file, "I")
-        self.mtime_ns = read_from_mmapped_file(index_file, "I")
-
-        # The ID of device containing this file
-        self.dev = read_from_mmapped_file(index_file, "I")
-
-        # The file's inode number
-        self.ino = read_from_mmapped_file(index_file, "I")
-
-        # 32-bit mode, split into (high to low bits)
-        self.mode = read_from_mmapped_file(index_file, "I")
-
-        # stat(2) data
-        self.uid = read_from_mmapped_file(index_file, "I")
-        self.gid = read_from_mmapped_file(index_file, "I")
-        self.size = read_from_mmapped_file(index_file, "I")
-
-        # Object name (SHA-1 ID) for the represented object. We are using
-        # SHA-1, which are 160 bits wide. That's 20 bytes.
-        self.sha1 = binascii.hexlify(index_file.read(
-            GIT_CHECKSUM_SIZE_BYTES)).decode("ascii")
-
-        # A 16-bit 'flags' field split into (high to low bits)
-        flags = read_from_mmapped_file(index_file, "H")
-        # 1-bit assume-valid
-        self.assume_valid = bool(flags & (0b10000000 << 8))
-        # 1-bit extended, must be 0 in version 2
-        self.extended = bool(flags & (0b01000000 << 8))
-        # 2-bit stage (?)
-        stage_one = bool(flags & (0b00100000 << 8))
-        stage_two = bool(flags & (0b00010000 << 8))
-        self.stage = stage_one, stage_two
+        # Read the fixed-size part of the entry in one go:
+        #   * the last time a file's metadata changed (ctime_s, ctime_ns)
+        #   * the last time a file's data changed (mtime_s, mtime_ns)
+        #   * the ID of device containing this file (dev)
+        #   * the file's inode number (ino)
+        #   * 32-bit mode, split into (high to low bits) (mode)
+        #   * stat(2) data (uid, gid, size)
+        #   * object name (SHA-1 ID) for the represented object. We are using
+        #     SHA-1, which are 160 bits wide. That's 20 bytes.
+        #   * a 16-bit 'flags' field split into (high to low bits)
+        (self.ctime_s, self.ctime_ns, self.mtime_s, self.mtime_ns, self.dev,
+                self.ino, self.mode, self.uid, self.gid, self.size,
+                self.sha1_bytes, flags) = _ENTRY_HEAD.unpack_from(index_file, offset)
+
+        # 1-bit assume-valid (bit 15)
+        self.assume_valid = bool((flags >> 15) & 1)
+        # 1-bit extended, must be 0 in version 2 (bit 14)
+        self.extended = bool((flags >> 14) & 1)
+        # 2-bit stage (bits 13 and 12)
+        self.stage = bool((flags >> 13) & 1), bool((flags >> 12) & 1)
 
         # 12-bit name length, if the length is less than 0xFFF (else, 0xFFF)
         self.name_len = flags & 0xFFF
 
         # 62 bytes so far
-        len_in_b = 62
+        len_in_b = _ENTRY_HEAD.size
 
         # (Version 3 or later) A 16-bit field, only applicable if the
         # "extended flag" above is 1, split into (high to low bits).
         if self.extended and (ver_num >= 3):
-            extra_flags = read_from_mmapped_file(index_file, "H")
-            # 1-bit reserved for future
-            self.reserved = bool(extra_flags & (0b10000000 << 8))
-            # 1-bit skip-worktree flag (used for sparse checkout)
-            self.skip_worktree = bool(extra_flags & (0b01000000 << 8))
-            # 1-bit intent-to-add flag (used by "git add -N")
-            self.intent_to_add = bool(extra_flags & (0b00100000 << 8))
+            (extra_flags,) = _U16.unpack_from(index_file, offset + len_in_b)
+            # 1-bit reserved for future (bit 15)
+            self.reserved = bool((extra_flags >> 15) & 1)
+            # 1-bit skip-worktree flag, used for sparse checkout (bit 14)
+            self.skip_worktree = bool((extra_flags >> 14) & 1)
+            # 1-bit intent-to-add flag, used by "git add -N" (bit 13)
+            self.intent_to_add = bool((extra_flags >> 13) & 1)
             # 13-bits unused, must be zero
-            unused = extra_flags & (0b00011111 << 8)
-            assert not unused, "Exp"
-            unused = extra_flags & (0b11111111)
-            assert not unused, "Exp"
+            self.unused = extra_flags & 0x1FFF
+            assert not self.unused, "GFG: Unused extended flags must be zero"
 
             len_in_b += 2
 
         # Entry path name (variable length) relative to top level directory
         # (without leading slash).
         assert ver_num != 4, "Reading self path name for `Version 4` not yet implemented."
-        if self.name_len < 0xFFF:
-            self.path_name = index_file.read(
-                self.name_len).decode("utf-8", "replace")
-            len_in_b += self.name_len
-        else:
+        if self.name_len >= 0xFFF:
             # Do it the hard way
-            raise Exception("GFG: Long path names are not supported")
+            raise GFGError("GFG: Long path names are not supported",
+                    detail=self.name_len)
+        len_in_b += self.name_len
 
         # 1-8 nul bytes as necessary to pad the self to a multiple of
         # eight bytes while keeping the name NUL-terminated.  (Version 4)
         # In version 4, the padding after the pathname does not exist.
-        if ver_num != 4:
-            pad_len_b = (8 - (len_in_b % 8)) or 8
-            null_bytes = index_file.read(pad_len_b)
-            assert set(null_bytes) == {0}, f"padding contained non-NUL: {null_bytes}"
+        pad_len_b = (8 - (len_in_b % 8)) or 8
+
+        # The lengths of both the path name and the padding are known at this
+        # point, so slice them in one go.
+        path_start = offset + len_in_b - self.name_len
+        path_end = path_start + self.name_len
+        path_and_padding = index_file[path_start:path_end + pad_len_b]
+        self.path_name_bytes = path_and_padding[:self.name_len]
+        self._path_name = None
+        assert not path_and_padding[self.name_len:].strip(b'\x00'), \
+                f"padding contained non-NUL: {path_and_padding[self.name_len:]}"
+
+        return path_end + pad_len_b
+
+def _get_parent_tree_path(path_component):
+    """Get the path of the parent tree for a cache tree entry
+
+    Args:
+        path_component - the path of the tree, e.g. './test_dir/test_dir_2'
+    Returns:
+        the path of the parent tree, e.g. './test_dir' ('./' for top-level dirs)
+    """
+    parent_path = os.path.dirname(path_component)
+    if parent_path == '.':
+        return './'
+    return parent_path
+
 
 # pylint: disable=R0903
 # Too few public methods (0/2) (too-few-public-methods)
@@ -714,12 +913,60 @@ class IndexTreeEntry():
         Lack of member methods suggests that I should've used named tuples
         here, but I need something that's mutable.
     """
+    __slots__ = ('_path_component', '_entry_count', '_num_subtrees', 'sha',
+            'basename_bytes', '_entry_count_bytes', '_num_subtrees_bytes')
+
     def __init__(self, path_component, entry_count, num_subtrees, sha):
         self.path_component = path_component
         self.entry_count = entry_count
         self.num_subtrees = num_subtrees
         self.sha = sha
 
+    @property
+    def path_component(self):
+        """ Path of this tree (relative to the top repo path, e.g. './test-dir-1') """
+        return self._path_component
+
+    @path_component.setter
+    def path_component(self, value):
+        self._path_component = value
+        # The last component of the path (as stored in the index)
+        self.basename_bytes = os.path.basename(value).encode()
+
+    @property
+    def entry_count(self):
+        """ Number of entries in the index that is covered by this tree """
+        return self._entry_count
+
+    @entry_count.setter
+    def entry_count(self, value):
+        self._entry_count = value
+        self._entry_count_bytes = None
+
+    @property
+    def entry_count_bytes(self):
+        """ `entry_count` as ASCII decimal number (as stored in the index) """
+        if self._entry_count_bytes is None:
+            self._entry_count_bytes = str(self._entry_count).encode()
+        return self._entry_count_bytes
+
+    @property
+    def num_subtrees(self):
+        """ Number of subtrees this tree has """
+        return self._num_subtrees
+
+    @num_subtrees.setter
+    def num_subtrees(self, value):
+        self._num_subtrees = value
+        self._num_subtrees_bytes = None
+
+    @property
+    def num_subtrees_bytes(self):
+        """ `num_subtrees` as ASCII decimal number (as stored in the index) """
+        if self._num_subtrees_bytes is None:
+            self._num_subtrees_bytes = str(self._num_subtrees).encode()
+        return self._num_subtrees_bytes
+
 class IndexTreeCacheExt():
     """Represents a Git tree cache extension.
 
@@ -730,11 +977,61 @@ class IndexTreeCacheExt():
     def __init__(self, tree_cache_extension=None):
         if tree_cache_extension not in (None, b''):
             self.entries = self.__parse(tree_cache_extension)
-            return
+        else:
+            self.ext_length = 0
+            self.signature = b"TREE"
+            self.entries = []
+
+        # The result of `print_to_bytes` (None if not available). Every
+        # method that modifies this extension goes through `__update_length`,
+        # which clears it.
+        self.__contents = None
+
+        # Lookup tables for the entries, keyed by the directory path and by
+        # the last component of the path. These are kept in sync with
+        # `self.entries` (see `__add_to_lookup_tables`).
+        self.entries_by_path = {}
+        self.entries_by_basename = {}
+        for entry in self.entries:
+            self.__add_to_lookup_tables(entry)
+
+        # The total number of sub-trees (i.e. sub-trees, their sub-trees and so
+        # on) for every entry, keyed by the directory path. In the list of
+        # entries, these are the entries that immediately follow the
+        # corresponding tree (see `add_entry`).
+        self.num_descendants = {}
+        for idx in range(len(self.entries) - 1, -1, -1):
+            # Entries are visited bottom-up, so the counts for sub-trees are
+            # already known
+            num_descendants = 0
+            subtree_idx = idx + 1
+            for _ in range(self.entries[idx].num_subtrees):
+                subtree_size = self.num_descendants[
+                        self.entries[subtree_idx].path_component] + 1
+                num_descendants += subtree_size
+                subtree_idx += subtree_size
+            self.num_descendants[self.entries[idx].path_component] = num_descendants
+
+    def __add_to_lookup_tables(self, entry):
+        """ Add `entry` to the lookup tables
 
-        self.ext_length = 0
-        self.signature = "TREE"
-        self.entries = []
+        INPUT:
+            entry - cache tree entry to add
+        """
+        self.entries_by_path[entry.path_component] = entry
+        self.entries_by_basename.setdefault(
+                os.path.basename(entry.path_component), []).append(entry)
+
+    def get_entry(self, dir_path):
+        """ Get the cache tree entry corresponding to dir_path
+
+        INPUT:
+            dir_path - directory for which to retrieve the entry (full path
+            relative to the top repo path, e.g. './test-dir-1')
+        RETURN:
+            The matching entry or None if there is no such entry
+        """
+        return self.entries_by_path.get(dir_path)
 
     def add_entry(self, new_tree: IndexTreeEntry):
         """ Insert a new tree to the cache tree extension
@@ -761,54 +1058,37 @@ class IndexTreeCacheExt():
             if len(self.entries) != 0:
                 raise GFGError("GFG: Trying to add tree entry for ''")
             self.entries.insert(0, new_tree)
+            self.__add_to_lookup_tables(new_tree)
+            self.num_descendants[new_tree.path_component] = 0
             self.__update_length()
             return
 
-        # Index of the parent directory in the tree cache index
-        parent_idx = 0
-        # Number of subtries from the parent tree entry to skip before
-        # inserting new_tree
-        num_sub_trees_to_skip = 0
-        parent_num_sub_trees = 0
-
         # Find the parent directory for new_tree and its index in the tree
         # cache.
-        found_parent = False
-        new_dir = Path(new_tree.path_component)
-        for idx, entry in enumerate(self.entries):
-            if Path(entry.path_component) == new_dir.parent:
-                parent_idx = idx
-                parent_num_sub_trees = int(entry.num_subtrees)
-                found_parent = True
-                break
+        parent_path = _get_parent_tree_path(new_tree.path_component)
+        parent = self.entries_by_path.get(parent_path)
+        if parent is None:
+            raise GFGError("GFG: Couldn't find a parent tree for",
+                    path=new_tree.path_component)
+        parent_idx = self.entries.index(parent)
 
-
-        if not found_parent:
-            raise GFGError(f"GFG: Couldn't find a parent tree for \
-                    {new_tree.path_component}")
-
-        # This is just the initial value for the number of sub-tree
-        # entires to skip. We also need go over all sub-trees of the
-        # parent tree and extract the corresponding number of sub-trees (that
-        # we also need to skip).
-        num_sub_trees_to_skip = parent_num_sub_trees
-
-        # Calculate the insertion index. For this, we need to iterate over all
-        # sub-trees of the parent tree (and their subtrees).
-        insertion_idx = parent_idx + 1
-        while num_sub_trees_to_skip != 0:
-            # Add all the sub-trees of this sub-tree - we need to skip them
-            # too.
-            num_sub_trees_to_skip += int(self.entries[insertion_idx].num_subtrees)
-            # We are visiting one sub-tree, so the number of sub-trees to skip
-            # drops by one and the insertion index goes up by 1 too.
-            num_sub_trees_to_skip -= 1
-            insertion_idx += 1
+        # The new tree goes after all the sub-trees of the parent tree (and
+        # their sub-trees, and so on).
+        insertion_idx = parent_idx + 1 + self.num_descendants[parent_path]
 
         self.entries.insert(insertion_idx, new_tree)
-        self.entries[parent_idx].num_subtrees = str(parent_num_sub_trees + 1)
+        self.__add_to_lookup_tables(new_tree)
+        parent.num_subtrees += 1
         self.__update_length()
 
+        # Update the descendant counts of all the trees above new_tree
+        self.num_descendants[new_tree.path_component] = 0
+        while True:
+            self.num_descendants[parent_path] += 1
+            if parent_path == "./":
+                break
+            parent_path = _get_parent_tree_path(parent_path)
+
     def __parse(self, extension):
         """ Parse the input tree cache extension, save the result to self
 
@@ -817,73 +1097,78 @@ class IndexTreeCacheExt():
         RETURN:
             None
         """
+        # pylint: disable=too-many-locals
 
         # Extension signature
-        self.signature = extension[0:4].decode("ascii")
-        assert self.signature == "TREE", "Not a Git tree cache extension"
+        self.signature = extension[0:4]
+        assert self.signature == b"TREE", "Not a Git tree cache extension"
 
         # 32-bit size of the extension
-        data_format_for_int = "! I"
-        self.ext_length = struct.unpack(data_format_for_int, extension[4:8])[0]
+        (self.ext_length,) = _U32.unpack_from(extension, 4)
 
         # Extension data
         te_entries = []
 
+        # Bind to locals - these are referenced on every iteration of the loop
+        # below
+        checksum_size = GIT_CHECKSUM_SIZE_BYTES
+        find = extension.index
+        append = te_entries.append
+
         subdir_count_stack = []
+        # Components of the path of the current tree (relative to the top
+        # directory)
+        current_path_components = []
         current_path = "./"
         # Index into the data that's being read
         idx = IndexTreeCacheExt.num_bytes_before_data
-        while idx < IndexTreeCacheExt.num_bytes_before_data + self.ext_length:
+        data_end = IndexTreeCacheExt.num_bytes_before_data + self.ext_length
+        while idx < data_end:
             if len(subdir_count_stack) != 0:
                 while subdir_count_stack[-1][1] == 0:
                     # Remove the last component from path
-                    subdir_count_stack.pop()
-                    current_path = os.path.dirname(current_path)
-
-            # Read NUL-terminated path component (relative to its parent
-            # directory)
-            null_char_after_path = extension.find(b'\x00', idx)
+                    if subdir_count_stack.pop()[0] != '':
+                        current_path_components.pop()
+
+            # Each entry starts with a line of the form:
+            #   <path component>\0<entry count> <number of subtrees>\n
+            # Locate the three separators first, then convert the fields
+            # (int() accepts ASCII bytes directly).
+            null_char_after_path = find(b'\x00', idx)
+            space_char_after_entry_count = find(b' ', null_char_after_path + 1)
+            new_line_char_after_subtrees = find(b'\n', space_char_after_entry_count + 1)
+
+            # NUL-terminated path component (relative to its parent directory)
             path_component = extension[idx:null_char_after_path].decode("ascii")
 
-            # Read ASCII decimal number of entries in the index that is
-            # covered by the tree this entry represents (entry_count). Skip the
-            # space (ASCII 32) that follows it.
-            idx = null_char_after_path + 1
-            space_char_after_entry_count = extension.find(b' ', idx)
-            entry_count = int(extension[idx:space_char_after_entry_count].decode("ascii"))
+            # ASCII decimal number of entries in the index that is covered by
+            # the tree this entry represents (entry_count)
+            entry_count = int(extension[null_char_after_path + 1:space_char_after_entry_count])
 
-            # Read ASCII decimal number that represents the number of subtrees
-            # this tree has
-            idx = space_char_after_entry_count + 1
-            num_subtrees = extension[idx:idx+1].decode("ascii")
+            # ASCII decimal number that represents the number of subtrees this
+            # tree has (this could be more than one digit)
+            num_subtrees = int(extension[
+                    space_char_after_entry_count + 1:new_line_char_after_subtrees])
 
             if path_component != '':
                 subdir_count_stack[-1][1] -= 1
-            subdir_count_stack.append([path_component, int(num_subtrees)])
-            if path_component != './':
-                current_path = os.path.join(current_path, path_component)
+                current_path_components.append(path_component)
+                current_path = './' + '/'.join(current_path_components)
+            subdir_count_stack.append([path_component, num_subtrees])
 
-            # Read a newline (ASCII 10)
-            idx += 1
-            new_line_char = extension[idx:idx+1].decode("ascii")
-            assert new_line_char == '\n', \
-                    f"Expecting a new line character, got {new_line_char}"
-            idx += 1
+            idx = new_line_char_after_subtrees + 1
 
             # If this entry has been invalided, save it and move to the next
             # one ...
             if entry_count == -1:
-                te_entries.append(IndexTreeEntry(current_path, entry_count,
-                    num_subtrees, None))
+                append(IndexTreeEntry(current_path, entry_count, num_subtrees, None))
                 continue
 
             # ... otherwise read object name for the object that would result
             # from writing this span of index as a tree
-            object_name_bytes = \
-                    binascii.hexlify(extension[idx:idx+GIT_CHECKSUM_SIZE_BYTES])
-            object_name = object_name_bytes.decode("ascii")
-            idx += GIT_CHECKSUM_SIZE_BYTES
-            te_entries.append(IndexTreeEntry(current_path, entry_count, num_subtrees, object_name))
+            object_name = extension[idx:idx+checksum_size].hex()
+            idx += checksum_size
+            append(IndexTreeEntry(current_path, entry_count, num_subtrees, object_name))
 
         return te_entries
 
@@ -898,31 +1183,38 @@ class IndexTreeCacheExt():
         if len(self.entries) == 0:
             return b''
 
-        contents = self.signature.encode()
-        contents += struct.pack("! I", self.ext_length)
+        if self.__contents is not None:
+            return self.__contents
+
+        # Collect all the parts first and join them at the end. Repeatedly
+        # concatenating `bytes` would copy the accumulated contents every time.
+        contents = [self.signature, _U32.pack(self.ext_length)]
+        append = contents.append
 
+        invalid_entry_count = GIT_INVALID_ENTRY_COUNT
         for entry in self.entries:
-            if entry.path_component != '':
-                contents += os.path.basename(entry.path_component).encode()
-            # Null character after the path
-            contents += struct.pack("! c", b'\x00')
+            # Path component (relative to the parent directory), followed by a
+            # null character
+            append(entry.basename_bytes)
+            append(b'\x00')
             # ASCII decimal number of entries in the index that is covered by
             # the tree this entry represents (entry_count)
-            contents += str(entry.entry_count).encode()
+            append(entry.entry_count_bytes)
             # A space (ASCII 32)
-            contents += struct.pack("! c", b'\x20')
+            append(b'\x20')
             # ASCII decimal number that represents the number of subtrees this
             # tree has
             # NOTE: num_subtrees could be more than one character!
-            contents += str(entry.num_subtrees).encode()
+            append(entry.num_subtrees_bytes)
             # A newline (ASCII 10)
-            contents += struct.pack("! c", b'\x0A')
+            append(b'\x0A')
             # Object name for the object that would result from writhing this
             # span of index as a tree
-            if entry.entry_count != GIT_INVALID_ENTRY_COUNT:
-                contents += binascii.unhexlify(entry.sha.encode())
+            if entry.entry_count != invalid_entry_count:
+                append(bytes.fromhex(entry.sha))
 
-        return contents
+        self.__contents = b''.join(contents)
+        return self.__contents
 
     def print_to_stdout(self):
         """ Print this cache tree to stdout """
@@ -943,45 +1235,75 @@ class IndexTreeCacheExt():
         INPUT:
             dir_path - directory to invalidate
         """
-        for entry in self.entries:
-            if Path(entry.path_component) not in Path(dir_path).parents:
+        # Cache tree paths are of the form './<some-dir>'
+        parent_paths = [os.path.join('.', parent) if parent != '.' else './'
+                for parent in map(str, Path(dir_path).parents)]
+
+        for parent_path in parent_paths:
+            entry = self.entries_by_path.get(parent_path)
+            if entry is None:
                 continue
             if entry.entry_count == GIT_INVALID_ENTRY_COUNT:
                 continue
 
-            # ASCII decimal number of entries in the index that is covered by
-            # the tree this entry represents (entry_count)
-            entry_count_num_ascii_chars = len(str(entry.entry_count))
+            # Invalid entries have neither a valid entry count nor an object
+            # name. The new length of the extension is calculated below.
             entry.entry_count = GIT_INVALID_ENTRY_COUNT
-
-            # Object name for the object that would result from writhing this
-            # span of index as a tree
             entry.sha = None
-            self.ext_length -= (GIT_CHECKSUM_SIZE_BYTES +
-                entry_count_num_ascii_chars - GIT_NUM_OF_ASCII_CHARS_INVALID_EC)
         self.__update_length()
 
     def validate(self):
-        """ Validate the contents stored in this extension """
-        contents = self.print_to_bytes()
-        if (len(contents) == 0) and self.ext_length == 0:
+        """ Validate the contents stored in this extension
+
+        The stored length is checked against the length calculated from the
+        entries, i.e. the extension is not packed.
+        """
+        if (len(self.entries) == 0) and self.ext_length == 0:
             return
 
         assert self.ext_length >= 0, "GFG: negative extension size!"
 
-        assert len(contents) ==\
-                self.ext_length + IndexTreeCacheExt.num_bytes_before_data,\
+        assert len(self.entries) != 0 and \
+                self.ext_length == self.__calculate_length(),\
                 "GFG: Invalid cache tree extension length"
 
     def __update_length(self):
-        """ Update the length of this extension based on the data stored """
-        contents = self.print_to_bytes()
-        # `contents` will contain extension signature and size, which should
-        # not be included in the extension size itself. Adjust the size
-        # accordingly. Note that this only makes sense if there is a non-empty
-        # extension.
-        if contents != b'':
-            self.ext_length = len(contents) - IndexTreeCacheExt.num_bytes_before_data
+        """ Update the length of this extension based on the data stored
+
+        Note that this only makes sense if there is a non-empty extension.
+        """
+        # The contents are about to change (or have already changed)
+        self.__contents = None
+
+        if len(self.entries) == 0:
+            return
+
+        self.ext_length = self.__calculate_length()
+
+    def __calculate_length(self):
+        """ Calculate the length of this extension from the entries
+
+        The length is calculated without actually packing the entries (see
+        `print_to_bytes` for the layout). Note that the extension signature
+        and size are not included in the extension size itself.
+
+        RETURN:
+            The length of the extension data (in bytes)
+        """
+        invalid_entry_count = GIT_INVALID_ENTRY_COUNT
+        ext_length = 0
+        for entry in self.entries:
+            # Path component, NUL, entry count, space, number of subtrees and
+            # newline ...
+            ext_length += len(entry.basename_bytes) \
+                    + len(entry.entry_count_bytes) + len(entry.num_subtrees_bytes) + 3
+            # ... followed by the object name (only for valid entries). This
+            # is normally GIT_CHECKSUM_SIZE_BYTES, but measure it to stay in
+            # sync with `print_to_bytes`.
+            if entry.entry_count != invalid_entry_count:
+                ext_length += len(entry.sha) // 2
+
+        return ext_length
 
     def get_entries_by_dirname(self, dir_to_retrieve):
         """Retrieve cache index entries corresponding to dir_to_retrieve
@@ -998,10 +1320,18 @@ class IndexTreeCacheExt():
         RETURN:
             A list of matching index entries
         """
-        matching_entries = [entry for entry in self.entries if\
+        # Both the full path and the last component must match the last
+        # component of `dir_to_retrieve`, so only the entries with that last
+        # component are checked.
+        candidates = self.entries_by_basename.get(os.path.basename(dir_to_retrieve), [])
+        matching_entries = [entry for entry in candidates if\
                 (entry.path_component == dir_to_retrieve or
                     os.path.basename(entry.path_component) == dir_to_retrieve)]
 
+        # Keep the order of `self.entries`
+        if len(matching_entries) > 1:
+            matching_entries.sort(key=self.entries.index)
+
         return matching_entries
 
     def update_tree_entry(self, new_entry: IndexTreeEntry):
@@ -1010,9 +1340,13 @@ class IndexTreeCacheExt():
         INPUT:
             new_entry - new tree entry to replace the old entry with
         """
-        for idx, entry in enumerate(self.entries):
-            if entry.path_component == new_entry.path_component:
-                self.entries[idx] = new_entry
+        old_entry = self.entries_by_path.get(new_entry.path_component)
+        if old_entry is not None:
+            self.entries[self.entries.index(old_entry)] = new_entry
+            self.entries_by_path[new_entry.path_component] = new_entry
+            same_basename = self.entries_by_basename[
+                    os.path.basename(new_entry.path_component)]
+            same_basename[same_basename.index(old_entry)] = new_entry
 
         self.__update_length()
 
@@ -7,19 +7,235 @@
 [3] https://www.dulwich.io/docs/tutorial/file-format.html#the-tree
 '''
 
+import abc
 import sys
-import binascii
 import os
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import hashlib
-import struct
 from pathlib import Path
 import datetime
 import time
+import mmap
+import re
+import tempfile
 import zlib
 from git_repository import GitRepository
 from git_index import GFGError
 
+# zlib compression level for loose objects. This matches Git's default
+# (core.looseCompression), which favours speed.
+_LOOSE_COMPRESSION_LEVEL = 1
+
+# Matches the author and the committer entries in commit objects [2], e.g.:
+#   "<name> <<e-mail>> <timestamp> <timezone>\n"
+_RE_AUTHOR_OR_COMMITTER = re.compile(rb'([^<]*?) ?<([^>]*)> (\S*) ([^\n]*)\n')
+
+# Loose object files at least this large are memory mapped rather than read.
+# For smaller files a single read() is cheaper than setting up a mapping.
+_MMAP_MIN_SIZE = 64 * 1024
+
+def _write_loose_object(object_hash, data):
+    """Compress and save an object to .git/objects
+
+    The object is written to a temporary file next to its final location
+    and then linked (or, if hard links are not supported, renamed) into
+    place, so that an interrupted write never leaves a truncated object
+    behind.
+
+    INPUT:
+        object_hash - SHA-1 of the object (i.e. of its uncompressed contents)
+        data - uncompressed object contents (including the header)
+    RAISES:
+        FileExistsError if the object file already exists
+    """
+    # Create the object sub-dir
+    full_dir = Path("./.git/objects/" + object_hash[0:2])
+    full_dir.mkdir(exist_ok=True)
+    file_path = full_dir / object_hash[2:]
+    # Don't compress objects that are already there
+    if file_path.exists():
+        raise FileExistsError(file_path)
+
+    temp_fd, temp_path = tempfile.mkstemp(prefix="tmp_obj_", dir=full_dir)
+    try:
+        with os.fdopen(temp_fd, "wb") as temp_file:
+            temp_file.write(zlib.compress(data, _LOOSE_COMPRESSION_LEVEL))
+        try:
+            # Unlike os.replace, os.link fails if the object already exists
+            os.link(temp_path, file_path)
+        except FileExistsError:
+            raise
+        except OSError:
+            # No hard links on this file system (e.g. FAT or some network
+            # mounts). Objects are content-addressed, so replacing an
+            # existing object with the same contents is harmless.
+            os.replace(temp_path, file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    # Loose objects are read-only (like in Git)
+    os.chmod(file_path, 0o444)
+
+class _ObjectCache():
+    """ Cache for decompressed (small) loose objects
+
+    The total size of the cached objects is bounded rather than their number,
+    so that a few large objects can't pin a lot of memory. The least recently
+    used objects are evicted first.
+    """
+    max_bytes = 1024 * 1024
+    max_object_size = 16 * 1024
+
+    def __init__(self):
+        self.objects = OrderedDict()
+        self.size = 0
+
+    def get(self, file_path):
+        """ Get the cached object for file_path (or None) """
+        data = self.objects.get(file_path)
+        if data is not None:
+            self.objects.move_to_end(file_path)
+        return data
+
+    def add(self, file_path, data):
+        """ Cache the object `data` read from file_path (if small enough) """
+        if len(data) > self.max_object_size:
+            return
+
+        self.objects[file_path] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.objects.popitem(last=False)
+            self.size -= len(evicted)
+
+_OBJECT_CACHE = _ObjectCache()
+
+def _decompress_object(file_path):
+    """ Read and decompress a (loose) Git object file
+
+    Most objects are small and are simply read and decompressed in one go.
+    Large files are decompressed straight from a memory mapping, i.e. the
+    compressed data is not copied into a bytes object first.
+
+    Small objects (e.g. trees and commits, which tend to be read more than
+    once) are cached, see _ObjectCache. Git objects are immutable and the
+    file path is derived from the object hash, so the cached data can never
+    go stale.
+
+    INPUT:
+        file_path - path of the Git object file to read
+    RETURN:
+        The decompressed object (i.e. including the header) as bytes
+    """
+    data = _OBJECT_CACHE.get(file_path)
+    if data is not None:
+        return data
+
+    with open(file_path, "rb") as input_file:
+        if os.fstat(input_file.fileno()).st_size < _MMAP_MIN_SIZE:
+            # zlib.decompress also rejects truncated data
+            data = zlib.decompress(input_file.read())
+            _OBJECT_CACHE.add(file_path, data)
+            return data
+
+        decompressor = zlib.decompressobj()
+        with mmap.mmap(input_file.fileno(), 0,
+                prot=mmap.PROT_READ) as object_file:
+            # The file is read front to back (madvise is only available
+            # in Python >= 3.8 and not on all platforms)
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                object_file.madvise(mmap.MADV_SEQUENTIAL)
+            data = decompressor.decompress(object_file)
+
+    if not decompressor.eof:
+        raise GFGError("GFG: Truncated Git object", path=file_path)
+
+    return data
+
+def _parse_header(data, object_hash=None):
+    """ Parse and validate the header of a Git object
+
+    Every Git object starts with a header that looks like this:
+            `<type> <content length><NUL>`
+
+    INPUT:
+        data - the (decompressed) Git object to parse
+        object_hash - the hash of the object (only used in error messages)
+    RETURN:
+        object_type, object_size, content_start - the type of the object, the
+        size of its contents and the offset of the contents within `data`
+    """
+    end_of_obj_type = data.find(b' ')
+    object_type = data[0:end_of_obj_type].decode("ascii")
+
+    null_char_after_obj_len = data.find(b'\x00', end_of_obj_type)
+    object_size = int(data[end_of_obj_type:null_char_after_obj_len])
+    content_start = null_char_after_obj_len + 1
+    if object_size != len(data) - content_start:
+        raise Exception(f"Malformed object {object_hash}: bad length")
+
+    return object_type, object_size, content_start
+
+# The (zero-padded) file modes used in tree objects. Git only ever uses these
+# few values, so they don't need to be decoded and padded for every entry.
+_TREE_ENTRY_MODES = {
+        b"100644": "100644",
+        b"100755": "100755",
+        b"120000": "120000",
+        b"160000": "160000",
+        b"40000": "040000"}
+
+def _parse_tree_entries(data, content_start):
+    """ Parse the entries of a Git tree object
+
+    Every entry looks like this (see [3]):
+            `<mode> <name><NUL><20-byte SHA-1>`
+    This is the hot loop when reading trees, hence it's kept free of any
+    object (i.e. `self`) lookups.
+
+    INPUT:
+        data - the (decompressed) Git tree object
+        content_start - offset of the first entry within `data`
+    RETURN:
+        A list of (file_mode, object_sha, file_name) tuples, where file_mode
+        is zero-padded to 6 digits and object_sha is a hex string
+    """
+    # The fields are decoded straight from a view of the data, i.e. without
+    # copying every field into a bytes object first
+    view = memoryview(data)
+    entries = []
+    append = entries.append
+    known_modes = _TREE_ENTRY_MODES
+
+    # Find the NUL character first - the mode and the name are then
+    # separated by the first space before it.
+    idx = content_start
+    end_of_data = len(data)
+    while idx < end_of_data:
+        null_char_after_file_name = data.index(b'\x00', idx)
+        space_after_file_mode_idx = data.find(b' ', idx,
+                null_char_after_file_name)
+
+        # Read file mode (read-only memoryviews are hashable, and compare equal
+        # to the corresponding bytes)
+        raw_file_mode = view[idx : space_after_file_mode_idx]
+        file_mode = known_modes.get(raw_file_mode)
+        if file_mode is None:
+            file_mode = str(raw_file_mode, "ascii").rjust(6, "0")
+
+        # Read file name
+        file_name = str(
+                view[space_after_file_mode_idx:null_char_after_file_name],
+                "ascii")
+
+        # Read object hash
+        idx = null_char_after_file_name + 21
+        append((file_mode, view[null_char_after_file_name + 1 : idx].hex(),
+                file_name))
+
+    return entries
+
 def create_git_object(repo : GitRepository, sha):
     """ Create a GitObject
 
@@ -38,27 +254,29 @@ def create_git_object(repo : GitRepository, sha):
     _, file_path = repo.get_object_path(sha)
 
     # If the blob data was not provided, read it from the corresponding file
-    data = bytes()
-    with open(file_path, "rb") as input_file:
-        data =  zlib.decompress(input_file.read())
-
-    end_of_obj_type = data.find(b' ')
-    object_type = data[0:end_of_obj_type].decode("ascii")
+    data = _decompress_object(file_path)
+    object_type, _, _ = _parse_header(data, sha)
 
+    # The object has already been read (and decompressed), so pass the data on
+    # rather than letting the constructor read it again
     if object_type == "tree":
-        return GitTreeObject(repo, sha)
+        return GitTreeObject(repo, sha, packed_data=data)
 
     if object_type == "blob":
-        return GitBlobObject(repo, sha)
+        return GitBlobObject(repo, sha, packed_data=data)
 
     if object_type == "commit":
-        return GitCommitObject(repo, sha)
+        return GitCommitObject(repo, sha, packed_data=data)
 
     assert False, "GFG: Unsupported object type"
 
-class GitObject():
+# pylint: disable=R0902
+# Too many instance attributes (10/7) (too-many-instance-attributes)
+class GitObject(abc.ABC):
     """ Represents an abstract Git object"""
     sha_len = 40
+    # The object type as used in Git object headers (set by the subclasses)
+    type_name = None
 
     def __init__(self, repo: GitRepository, object_hash: str = None, packed_data: bytes = None):
         self.repo = repo
@@ -68,8 +286,15 @@ class GitObject():
         self.data = packed_data
         # The type of this object (tree, blob, commit)
         self.object_type = None
+        # The size of the object contents (as recorded in the header) and the
+        # offset of the contents within `self.data`. Only set for existing
+        # objects.
+        self.object_size = None
+        self.content_start = None
         # Does this object already exist as a Git object?
         self.exists = True
+        # The hash of `self.data` (once calculated), see `verify`
+        self.__data_hash = None
 
         if self.object_hash is None and self.data is None:
             self.exists = False
@@ -77,6 +302,7 @@ class GitObject():
 
         if self.object_hash is None:
             self.object_hash = hashlib.sha1(self.data).hexdigest()
+            self.__data_hash = self.object_hash
 
         # If the object does not exist yet, there's nothing else to do at the
         # moment.
@@ -90,12 +316,12 @@ class GitObject():
 
         # If the blob data was not provided, read it from the corresponding file
         if self.data is None:
-            with open(self.file_path, "rb") as input_file:
-                data =  input_file.read()
-                self.data = zlib.decompress(data)
+            self.data = _decompress_object(self.file_path)
 
-        end_of_obj_type = self.data.find(b' ')
-        self.object_type = self.data[0:end_of_obj_type].decode("ascii")
+        # Parse and validate the header once. The subclasses only need the
+        # offsets calculated here.
+        self.object_type, self.object_size, self.content_start = \
+                _parse_header(self.data, self.object_hash)
 
     def print_to_stdout(self, pretty_print : bool, type_only : bool):
         """ Read this object and print to stdout"""
@@ -104,34 +330,50 @@ class GitObject():
                 "GFG: Wrong `print` version"
         raise Exception("Unimplemented!")
 
+    @abc.abstractmethod
+    def print_to_bytes(self):
+        """ Print this object to a bytes object (implemented by the subclasses)
+
+        INPUT - none
+        RETURN - this Git object as Python bytes object
+        """
+
+    def save_to_file(self):
+        """ Save this object to an actual file
+
+        The object (see `print_to_bytes` in the subclasses) is compressed
+        using zlib and saved to .git/objects.
+
+        RAISES:
+            GFGError if the object file already exists
+        """
+        try:
+            _write_loose_object(self.object_hash, self.print_to_bytes())
+        except FileExistsError as exc:
+            raise GFGError("GFG! This object already exists",
+                    path=self.object_hash, detail=self.type_name) from exc
+
     def verify(self):
         """ Trivial sanity check """
-        assert self.object_hash == hashlib.sha1(self.data).hexdigest(), \
+        # Hash the data at most once
+        if self.__data_hash is None:
+            self.__data_hash = hashlib.sha1(self.data).hexdigest()
+
+        assert self.object_hash == self.__data_hash, \
             "GFG: Git hash and the actual data don't match"
 
-# pylint: disable=R0902
-# Too many instance attributes (8/7) (too-many-instance-attributes)
 class GitCommitObject(GitObject):
     """ Represents a Git commit object"""
+    type_name = "commit"
     Author = namedtuple('Author', 'name email timestamp timezone')
     Committer = namedtuple('Committer', 'name email timestamp timezone')
 
     def __parse(self):
-        # Read the object type
-        space_after_obj_type = self.data.find(b' ')
-        self.object_type = self.data[0:space_after_obj_type].decode("ascii")
+        # The header has already been parsed and validated (see GitObject)
         assert self.object_type == "commit", "GFG: This is not a commit"
 
-        # Read and validate the object size
-        null_char_after_obj_len = self.data.find(b'\x00', space_after_obj_type)
-        self.object_size = int(
-                self.data[space_after_obj_type:null_char_after_obj_len].decode("ascii")
-                )
-        if self.object_size != len(self.data)-null_char_after_obj_len-1:
-            raise Exception(f"Malformed object {self.object_hash}: bad length")
-
         # Read: parent, author, committer, tree
-        idx = null_char_after_obj_len + 1
+        idx = self.content_start
         while True:
             space_after_field_id = self.data.find(b' ', idx)
 
@@ -170,24 +412,6 @@ class GitCommitObject(GitObject):
         self.commit_msg = str(self.data[idx:].decode("ascii"))
         self.commit_msg.rstrip()
 
-    def save_to_file(self):
-        """ Save this tree object to an actual file """
-
-        dir_name = self.object_hash[0:2]
-        file_name = self.object_hash[2:]
-
-        # Create the object sub-dir
-        full_dir = Path("./.git/objects/" + dir_name)
-        full_dir.mkdir(exist_ok=True)
-
-        # Create the object file
-        file_path = Path("./.git/objects/" + dir_name + "/" + file_name)
-        if os.path.exists(file_path):
-            raise GFGError(f"GFG! This commit already exists: {self.object_hash}!")
-
-        # Save the object file
-        file_path.write_bytes(zlib.compress(self.print_to_bytes()))
-
     def print_to_bytes(self):
         """ Print this object to a bytes object as per the spec [2]
 
@@ -315,16 +539,14 @@ class GitCommitObject(GitObject):
         RETURN:
             A tuple that contains name, email, timestamp and timezone
         """
-        email_start_idx = data.find(b'<', begin_idx) + 1
-        email_end_idx = data.find(b'>', email_start_idx)
-        timestamp_start_idx = data.find(b' ', email_end_idx) + 1
-        timezone_start_idx = data.find(b' ', timestamp_start_idx) + 1
-        timezone_end_idx = data.find(b'\n', timezone_start_idx)
+        # All four fields are extracted in one go
+        match = _RE_AUTHOR_OR_COMMITTER.match(data, begin_idx)
+        if match is None:
+            raise GFGError("GFG: Malformed author or committer entry",
+                    detail=data[begin_idx:data.find(b'\n', begin_idx)])
 
-        name = str(data[begin_idx:email_start_idx - 2].decode("ascii"))
-        email = str(data[email_start_idx:email_end_idx].decode("ascii"))
-        timestamp = str(data[timestamp_start_idx:timezone_start_idx-1].decode("ascii"))
-        timezone = str(data[timezone_start_idx:timezone_end_idx].decode("ascii"))
+        name, email, timestamp, timezone = (field.decode("ascii")
+                for field in match.groups())
 
         return name, email, timestamp, timezone
 
@@ -395,64 +617,20 @@ class GitCommitObject(GitObject):
 
 class GitTreeObject(GitObject):
     """ Represents a Git tree object"""
+    type_name = "tree"
 
     def __parse(self):
-        # Read the object type
-        space_after_obj_type = self.data.find(b' ')
-        object_type = self.data[0:space_after_obj_type].decode("ascii")
-        assert object_type == "tree", "GFG: This is not a tree"
-
-        # Read and validate object size
-        null_char_after_obj_len = self.data.find(b'\x00', space_after_obj_type)
-        self.object_size = int(
-                self.data[space_after_obj_type:null_char_after_obj_len]\
-                        .decode("ascii"))
-        if self.object_size != len(self.data)-null_char_after_obj_len-1:
-            raise Exception(f"Malformed object {self.object_hash}: bad length")
-
-        # Read all the obhe
-        idx = null_char_after_obj_len + 1
-        bytes_read = 0
-        while bytes_read < self.object_size:
-            # Read file mode
-            space_after_file_mode_idx = self.data.find(b' ', idx)
-            file_mode = self.data[idx : space_after_file_mode_idx].decode("ascii").rjust(6, "0")
-
-            # Read file name
-            null_char_after_file_name = self.data.find(b'\x00', idx)
-            file_name = self.data[
-                    space_after_file_mode_idx:null_char_after_file_name
-                    ].decode("ascii")
-
-            # Read object hash
-            idx_new = null_char_after_file_name + 21
-            obj_sha = self.data[null_char_after_file_name + 1 : idx_new]
-
-            # Get object type. Note that this is not stored in the tree object
-            # and needs to be retrieved by reading the correspondig Git object.
-            git_obj = GitObject(self.repo, object_hash = obj_sha.hex())
-            self.tree_entries.append((file_mode, git_obj.object_type, obj_sha.hex(), file_name))
-
-            bytes_read += (idx_new - idx)
-            idx = idx_new
-
-    def save_to_file(self):
-        """ Save this tree object to an actual file """
-
-        dir_name = self.object_hash[0:2]
-        file_name = self.object_hash[2:]
-
-        # Create the object sub-dir
-        full_dir = Path("./.git/objects/" + dir_name)
-        full_dir.mkdir(exist_ok=True)
-
-        # Create the object file
-        file_path = Path("./.git/objects/" + dir_name + "/" + file_name)
-        if os.path.exists(file_path):
-            raise GFGError(f"GFG! This tree already exists: {self.object_hash}!")
-
-        # Save the object file
-        file_path.write_bytes(zlib.compress(self.print_to_bytes()))
+        # The header has already been parsed and validated (see GitObject)
+        assert self.object_type == "tree", "GFG: This is not a tree"
+
+        # Get object types. Note that these are not stored in the tree object
+        # and need to be retrieved from the correspondig Git objects (only
+        # their headers are read).
+        peek_object_type = self.repo.peek_object_type
+        for file_mode, obj_sha, file_name in _parse_tree_entries(
+                self.data, self.content_start):
+            self.tree_entries.append(
+                    (file_mode, peek_object_type(obj_sha), obj_sha, file_name))
 
     def print_to_bytes(self):
         """ Print this object to a bytes object as per the spec [3] """
@@ -472,17 +650,16 @@ class GitTreeObject(GitObject):
             # Null character
             contents += b'\x00'
             # Object SHA
-            contents += binascii.unhexlify(entry[2].encode())
+            contents += bytes.fromhex(entry[2])
         data += str(len(contents) - 1).encode()
         data += contents
 
         return data
 
     def __init__(self, repo: GitRepository, object_hash: str = None, blobs: list
-            = None, trees: list = None):
-        super().__init__(repo, object_hash)
+            = None, trees: list = None, packed_data: bytes = None):
+        super().__init__(repo, object_hash, packed_data)
 
-        self.object_size = 0
         self.tree_entries = []
 
         # If this tree already exists, just read it
@@ -535,6 +712,7 @@ class GitBlobObject(GitObject):
     In order to create a Git blob, you need to supply either object's has or
     packed blob content.
     """
+    type_name = "blob"
 
     @staticmethod
     def get_packed_blob(file_to_read=None):
@@ -550,28 +728,24 @@ class GitBlobObject(GitObject):
             data - packed data for the generated blob file
 
         """
+        # Blobs store the raw file contents, so read (and keep) bytes. Note
+        # that the content length in the header is in bytes too.
         if file_to_read is not None:
-            with open(file_to_read, "r", encoding = 'utf-8') as input_file:
+            with open(file_to_read, "rb") as input_file:
                 data = input_file.read()
         else:
-            # pylint: disable=R1713
-            # Pylint suggests using `data.join(sys.stdin)` here instead of the
-            # `for` loop, but that doesn't work. AFAIK, `sys.stdin` is an
-            # iterable so it should actually work. For now I'm just disabling
-            # the Pylint warning for this block.
-            data=str()
-            for line in sys.stdin:
-                data += line
+            data = sys.stdin.buffer.read()
 
-        header_str = f"blob {len(data)}"
-        header_fmt = f"{len(header_str)}s"
-        packed_data = struct.pack(header_fmt, header_str.encode())
+        # Header and contents are put together in one go (i.e. one allocation)
+        return b"blob %d\x00%b" % (len(data), data)
 
-        packed_data += struct.pack('B', 0)
-        struct_fmt = f"{len(data)}s"
-        packed_data += struct.pack(struct_fmt, data.encode())
+    def print_to_bytes(self):
+        """ Print this blob object to a bytes object
 
-        return packed_data
+        INPUT - none
+        RETURN - the packed blob (i.e. header and contents)
+        """
+        return self.data
 
     def print_to_stdout(self, pretty_print : bool, type_only : bool):
         """ Read this blob object and print it to stdout"""
@@ -579,23 +753,18 @@ class GitBlobObject(GitObject):
             print(f"fatal: Not a valid object name {self.object_hash}", file=sys.stderr)
             return
 
-        # Read object type
-        space_after_obj_type = self.data.find(b' ')
-        object_type = self.data[0:space_after_obj_type].decode("ascii")
-        assert object_type == "blob", \
+        # The header has already been parsed and validated (see GitObject)
+        assert self.object_type == "blob", \
             "GFG: This is not a object"
         if type_only:
             print("blob")
             return
 
-        # Read and validate object size
-        null_char_after_obj_len = self.data.find(b'\x00', space_after_obj_type)
-        object_size = int(self.data[space_after_obj_type:null_char_after_obj_len].decode("ascii"))
-        if object_size != len(self.data)-null_char_after_obj_len-1:
-            raise Exception(f"Malformed object {self.object_hash}: bad length")
-
-        # Print the contents
-        print(self.data[null_char_after_obj_len+1:].decode("ascii"), end="")
+        # Print the contents. Write the raw bytes (this also works for binary
+        # blobs) without copying them. Flush whatever has been printed so far
+        # first, so that the output stays in order.
+        sys.stdout.flush()
+        sys.stdout.buffer.write(memoryview(self.data)[self.content_start:])
 
     def write(self):
         """Save this blob file
@@ -603,19 +772,7 @@ class GitBlobObject(GitObject):
         The blob file is compressed using zlib and saved to .git/objects as a
         physical file. If the file already exists, do nothing.
         """
-        dir_name = self.object_hash[0:2]
-        file_name = self.object_hash[2:]
-
-        # Create the object sub-dir
-        full_dir = Path("./.git/objects/" + dir_name)
-        full_dir.mkdir(exist_ok=True)
-
-        # Create the object file
-        file_path = Path("./.git/objects/" + dir_name + "/" + file_name)
         try:
-            file_path.touch(exist_ok=False)
+            _write_loose_object(self.object_hash, self.print_to_bytes())
         except FileExistsError:
-            return
-
-        # Save the object file
-        file_path.write_bytes(zlib.compress(self.data))
+            pass
@@ -11,8 +11,10 @@ Implements a class that represents a Git repository
 
 import configparser
 import os
-import glob
+import zlib
 from pathlib import Path
+from gfg_common import GFGError
+from gfg_common import GIT_CHECKSUM_SIZE_BYTES
 
 class GitRepository():
     """A git repository"""
@@ -53,15 +55,34 @@ class GitRepository():
         RETURN:
             True if `object_hash` exists, False otherwise
         """
-        # Calculate the file path from the object hash
+        return len(self.__find_object_files(object_hash)) == 1
+
+    def __find_object_files(self, object_hash: str):
+        """ Find the object files matching object_hash
+
+        Full object hashes are checked directly. Shortened hashes are matched
+        against the contents of the corresponding object sub-directory.
+
+        INPUT:
+            object_hash - Git object hash (full or shortened) to look for
+        RETURN:
+            A list with the paths of all matching object files
+        """
         file_dir = Path(self.git_dir) / "objects" / object_hash[0:2]
-        file_path = Path(file_dir) / object_hash[2:]
 
-        list_of_matching_files = glob.glob(str(file_path) + "*")
-        if len(list_of_matching_files) == 1:
-            return True
+        # A full hash identifies at most one file, so there's no need to list
+        # the directory
+        if len(object_hash) == 2 * GIT_CHECKSUM_SIZE_BYTES:
+            file_path = file_dir / object_hash[2:]
+            return [file_path] if file_path.is_file() else []
 
-        return False
+        file_name_prefix = object_hash[2:]
+        try:
+            with os.scandir(file_dir) as dir_entries:
+                return [Path(dir_entry.path) for dir_entry in dir_entries
+                        if dir_entry.name.startswith(file_name_prefix)]
+        except OSError:
+            return []
 
     def get_head_rev(self):
         """ Get the revision pointed to by .git/HEAD """
@@ -128,19 +149,57 @@ class GitRepository():
             dir, path - the directory and the full path of the object
             corresponding to the input Git object
         """
-        assert self.is_object_in_repo(object_hash)
+        # If the hash was provided by the user, it might have been a shortened
+        # version. If that's the case, the file path is that of the only
+        # matching object file.
+        list_of_matching_files = self.__find_object_files(object_hash)
+        assert len(list_of_matching_files) == 1
 
-        # Calculate the file path from the object hash
         file_dir = Path(self.git_dir) / "objects" / object_hash[0:2]
-        file_path = Path(file_dir) / object_hash[2:]
+        return (file_dir, list_of_matching_files[0])
 
-        # If the hash was provided by the user, it might have been a shortened
-        # version. If that's the case, self.file_path needs to recalculated.
-        list_of_matching_files = glob.glob(str(file_path) + "*")
-        if len(list_of_matching_files) == 1:
-            file_path = Path(list_of_matching_files[0])
+    def peek_object_type(self, object_hash: str):
+        """ Get the type of a Git object without reading the whole object
+
+        Only the beginning of the object file is decompressed - just enough to
+        read the object type from the header (e.g. "blob 1234\\0").
 
-        return (file_dir, file_path)
+        INPUT:
+            object_hash - Git object hash of the object to check
+        RETURN:
+            The object type ("blob", "tree" or "commit") or None if `object_hash`
+            doesn't exist
+        RAISES:
+            GFGError if the object header is malformed
+        """
+        object_type = self.object_types.get(object_hash)
+        if object_type is not None:
+            return object_type
+
+        if not self.is_object_in_repo(object_hash):
+            return None
+        _, file_path = self.get_object_path(object_hash)
+
+        # The longest type is "commit", so the type must appear within the
+        # first few bytes of the decompressed header
+        max_header_len = 32
+        decompressor = zlib.decompressobj()
+        header = b''
+        with open(file_path, "rb") as object_file:
+            while b' ' not in header and len(header) < max_header_len:
+                chunk = decompressor.unconsumed_tail or object_file.read(256)
+                if not chunk:
+                    break
+                header += decompressor.decompress(chunk,
+                        max_header_len - len(header))
+
+        end_of_obj_type = header.find(b' ')
+        if end_of_obj_type == -1:
+            raise GFGError("GFG: Malformed object header", path=object_hash)
+
+        object_type = header[0:end_of_obj_type].decode("ascii")
+        self.object_types[object_hash] = object_type
+        return object_type
 
     def __init__(self, directory=".", force_init=True):
         # The worktree directory for this repository
@@ -149,6 +208,10 @@ class GitRepository():
         self.git_dir = self.worktree_dir.joinpath(".git")
         # Contents of the Git config file for this repository (i.e. .git/config)
         self.git_config = None
+        # Types of the objects looked up so far, keyed by the object hash (see
+        # `peek_object_type`). Git objects are immutable, so this never needs
+        # invalidating.
+        self.object_types = {}
 
         # Find the _top_ working/Git directory
         if not os.path.isdir(self.git_dir):
@@ -11,6 +11,7 @@ from shutil import rmtree
 from pathlib import Path
 import subprocess
 import unittest
+from unittest import mock
 import os
 import gfg_common
 
@@ -36,5 +37,64 @@ class TestGitRepositoryClass(unittest.TestCase):
         self.assertTrue(name, "GFG Test")
         self.assertTrue(email, "gfg@gfg.test")
 
+    def test_get_name_and_email_identity(self):
+        """ Test that get_name_and_email returns an Identity """
+        identity = gfg_common.get_name_and_email(self.test_repo_dir)
+
+        # Values extracted from create_test_repo.sh
+        self.assertEqual(identity.name, "GFG Test")
+        self.assertEqual(identity.email, "gfg@gfg.test")
+
+    def test_get_name_and_email_partial_config(self):
+        """ Test the get_name_and_email method when the local config is missing
+        some of the fields (these should be read from the global config) """
+        subprocess.run(["git", "config", "--local", "--unset", "user.name"],
+                cwd=self.test_repo_dir, check=True)
+
+        home_dir = self.test_repo_dir / "home"
+        home_dir.mkdir()
+        with open(home_dir / ".gitconfig", "w", encoding='utf-8') as config:
+            config.write("[user]\n\tname = GFG Global\n\temail = global@gfg.test\n")
+
+        with mock.patch.object(gfg_common, "_GLOBAL_GITCONFIG",
+                str(home_dir / ".gitconfig")):
+            name, email = gfg_common.get_name_and_email(self.test_repo_dir)
+
+        self.assertEqual(name, "GFG Global")
+        self.assertEqual(email, "gfg@gfg.test")
+
+    def test_get_name_and_email_repeated_key(self):
+        """ Test the get_name_and_email method when a key is set more than once
+        (like in Git, the last value should be used) """
+        subprocess.run(["git", "config", "--local", "--add", "user.name",
+                "GFG Test 2"], cwd=self.test_repo_dir, check=True)
+
+        name, _ = gfg_common.get_name_and_email(self.test_repo_dir)
+
+        self.assertEqual(name, "GFG Test 2")
+
+    def test_get_name_and_email_no_config(self):
+        """ Test the get_name_and_email method for a missing config file """
+        rmtree(self.test_repo_dir / ".git")
+
+        self.assertRaises(gfg_common.GFGError,
+                gfg_common.get_name_and_email, self.test_repo_dir)
+
+    def test_gfg_error_message(self):
+        """ Test that GFGError puts together its message from the context """
+        self.assertEqual(str(gfg_common.GFGError("GFG: Oops")), "GFG: Oops")
+        self.assertEqual(
+                str(gfg_common.GFGError("GFG: Oops", path="a/b", detail="c")),
+                "GFG: Oops: a/b (c)")
+
+    def test_get_blob_hash(self):
+        """ Test the get_blob_hash method """
+        # gfg-test-file-1, see create_test_repo.sh (and test_repository.py for
+        # the expected hash)
+        blob_hash = gfg_common.get_blob_hash(
+                self.test_repo_dir / "gfg-test-file-1")
+        self.assertEqual(blob_hash.hex(),
+                "81c545efebe5f57d4cab2ba9ec294c4b0cadf672")
+
 if __name__ == "__main__":
     unittest.main()
@@ -12,6 +12,7 @@ from shutil import rmtree
 import os
 from pathlib import Path
 import unittest
+from unittest import mock
 import hashlib
 import subprocess
 import git_index
@@ -21,6 +22,7 @@ class TestIndexClass(unittest.TestCase):
     """Top unit test class for this module
 
     """
+    # pylint: disable=too-many-public-methods
     file_name_in = "index_test_in"
     file_name_out = "index_test_out"
     index_file = None
@@ -73,6 +75,48 @@ class TestIndexClass(unittest.TestCase):
         # Delete the generated index file
         os.remove(self.file_name_out)
 
+    def test_write_failure_keeps_file(self):
+        """Writing an index that can't be packed must not destroy the file
+
+        The original file has to remain intact (and no lock file can be left
+        behind) if packing fails half-way.
+        """
+        copyfile(self.file_name_in, self.file_name_out)
+        with open(self.file_name_out, "rb") as file_out:
+            original_contents = file_out.read()
+
+        # Fail half-way through writing the entries
+        with mock.patch.object(git_index.IndexEntry, "print_to_bytearray",
+                side_effect=OSError("Simulated write failure")), \
+                self.assertRaises(OSError):
+            self.index_file.print_to_file(self.file_name_out)
+
+        with open(self.file_name_out, "rb") as file_out:
+            self.assertEqual(file_out.read(), original_contents)
+        self.assertFalse(os.path.exists(self.file_name_out + ".lock"))
+
+        # Delete the generated index file
+        os.remove(self.file_name_out)
+
+    def test_write_locked_file(self):
+        """Writing an index that is locked (i.e. there's a lock file) fails
+        """
+        copyfile(self.file_name_in, self.file_name_out)
+        with open(self.file_name_out + ".lock", "wb"):
+            pass
+
+        self.assertRaises(git_index.GFGError,
+                self.index_file.print_to_file, self.file_name_out)
+
+        # Neither the index file nor the lock file can be touched
+        with open(self.file_name_in, "rb") as file_in, \
+                open(self.file_name_out, "rb") as file_out:
+            self.assertEqual(file_in.read(), file_out.read())
+        self.assertEqual(os.path.getsize(self.file_name_out + ".lock"), 0)
+
+        os.remove(self.file_name_out + ".lock")
+        os.remove(self.file_name_out)
+
     def test_get_entry_sanity(self):
         """Modify index file - sanity check
         """
@@ -104,6 +148,17 @@ class TestIndexClass(unittest.TestCase):
         # Delete the generated index file
         os.remove(self.file_name_out)
 
+    def test_rename_entry(self):
+        """Look up an index entry after changing its path name
+        """
+        entries = self.index_file.get_entries_by_filename(self.test_files[0])
+        entries[0].path_name = "test-dir-1/renamed.txt"
+
+        self.assertEqual(self.index_file.get_entries_by_filename(self.test_files[0]), [])
+        self.assertEqual(self.index_file.get_entries_by_filename("renamed.txt"), entries)
+        self.assertIn(entries[0], self.index_file.get_blobs("./test-dir-1"))
+        self.assertNotIn(entries[0], self.index_file.get_blobs("./"))
+
     def test_add_file(self):
         """Test the add_file method
         """
@@ -135,6 +190,47 @@ class TestIndexClass(unittest.TestCase):
         # Delete the dummy test file
         os.remove(test_file)
 
+    def test_add_files(self):
+        """Test the add_files method (i.e. adding several files in one go)
+        """
+        test_files = ["ADD_FILES_TEST_FILE_1.py", "ADD_FILES_TEST_FILE_2.py"]
+        for test_file in test_files:
+            Path(test_file).touch()
+
+        num_entries = self.index_file.header.num_entries
+        self.index_file.add_files(test_files)
+
+        for test_file in test_files:
+            entries = self.index_file.get_entries_by_filename(test_file)
+            self.assertEqual(len(entries), 1)
+        self.assertEqual(self.index_file.header.num_entries, num_entries + 2)
+
+        # The index file has been written once and must be valid
+        self.index_file.validate()
+
+        for test_file in test_files:
+            os.remove(test_file)
+
+    def test_add_files_failure_keeps_index(self):
+        """Adding files must not destroy the index if it can't be packed
+        """
+        test_file = "ADD_FILES_TEST_FILE_1.py"
+        Path(test_file).touch()
+        with open(self.file_name_in, "rb") as file_in:
+            original_contents = file_in.read()
+
+        # Fail half-way through writing the entries
+        with mock.patch.object(git_index.IndexEntry, "print_to_bytearray",
+                side_effect=OSError("Simulated write failure")), \
+                self.assertRaises(OSError):
+            self.index_file.add_files([test_file])
+
+        with open(self.file_name_in, "rb") as file_in:
+            self.assertEqual(file_in.read(), original_contents)
+        self.assertFalse(os.path.exists(self.file_name_in + ".lock"))
+
+        os.remove(test_file)
+
     def test_get_trees_to_add_or_update(self):
         """Test the `get_trees_to_add_or_update` method
         """
@@ -216,6 +312,40 @@ class TestIndexClass(unittest.TestCase):
         self.assertTrue(self.index_file.checksum == new_sha1,
                 "Checksum has been succesfully updated")
 
+    def test_entry_flags_round_trip(self):
+        """ Verify that the flags of an index entry survive write + read
+        """
+        entry = self.index_file.get_entries_by_filename(self.test_files[0])[0]
+        entry.assume_valid = True
+        entry.stage = (True, False)
+
+        entry_read = git_index.IndexEntry()
+        entry_read.read(entry.print_to_bytes(2), 0, 2)
+
+        self.assertTrue(entry_read.assume_valid)
+        self.assertFalse(entry_read.extended)
+        self.assertEqual(entry_read.stage, (True, False))
+        self.assertEqual(entry_read.name_len, entry.name_len)
+        self.assertEqual(entry_read.path_name, entry.path_name)
+
+    def test_entry_extended_flags_round_trip(self):
+        """ Verify that the extended (version 3) flags survive write + read
+        """
+        entry = self.index_file.get_entries_by_filename(self.test_files[0])[0]
+        entry.extended = True
+        entry.reserved = False
+        entry.skip_worktree = True
+        entry.intent_to_add = False
+
+        entry_read = git_index.IndexEntry()
+        entry_read.read(entry.print_to_bytes(3), 0, 3)
+
+        self.assertTrue(entry_read.extended)
+        self.assertFalse(entry_read.reserved)
+        self.assertTrue(entry_read.skip_worktree)
+        self.assertFalse(entry_read.intent_to_add)
+        self.assertEqual(entry_read.path_name, entry.path_name)
+
     def test_file_mode(self):
         """ Verify that file entries in index have correct file mode
         """
@@ -336,6 +466,24 @@ class TestIndexClass(unittest.TestCase):
         self.assertRaises(git_index.GFGError,
                 self.index_file.extension_tree_cache.add_entry, new_tree)
 
+    def test_tree_cache_extension_many_subtrees(self):
+        """ Test parsing a tree with more than 9 sub-trees
+
+        The number of sub-trees is stored as ASCII text, so it can take more
+        than one character.
+        """
+        sha = bytes(git_index.GIT_CHECKSUM_SIZE_BYTES)
+        data = b'\x0012 12\n' + sha
+        for idx in range(12):
+            data += f'dir-{idx}'.encode() + b'\x001 0\n' + sha
+        extension = b'TREE' + len(data).to_bytes(4, "big") + data
+
+        tree_cache = git_index.IndexTreeCacheExt(extension)
+        self.assertEqual(len(tree_cache.entries), 13)
+        self.assertEqual(tree_cache.entries[0].num_subtrees, 12)
+        self.assertEqual(tree_cache.entries[-1].path_component, "./dir-11")
+        self.assertEqual(tree_cache.print_to_bytes(), extension)
+
 
 if __name__ == "__main__":
     unittest.main()
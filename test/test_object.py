@@ -89,6 +89,19 @@ class TestGitRepositoryClass(unittest.TestCase):
             # Return to the original test dir
             os.chdir(self.test_dir)
 
+    def test_parse_author_or_committer(self):
+        """ Parse author/committer entries, including ones with an empty name
+        """
+        parse = git_object.GitCommitObject.parse_author_or_committer
+
+        data = b"author Andrzej W <andrzej@gfg.com> 1614446422 +0000\n"
+        self.assertEqual(parse(data, len("author ")),
+                ("Andrzej W", "andrzej@gfg.com", "1614446422", "+0000"))
+
+        data = b"committer <andrzej@gfg.com> 1614446422 +0000\n"
+        self.assertEqual(parse(data, len("committer ")),
+                ("", "andrzej@gfg.com", "1614446422", "+0000"))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -98,6 +98,19 @@ class TestGitRepositoryClass(unittest.TestCase):
         self.assertTrue(repo.is_object_in_repo("492f68c88a08d083dfae178bd85cfcc38f4f0851"))
         self.assertTrue(repo.is_object_in_repo("492f"))
 
+    def test_peek_object_type(self):
+        """ Verify that GitRepository reads the types of objects correctly"""
+        repo = git_repository.GitRepository.get_repo(self.test_repo_dir)
+
+        # gfg-test-file-1
+        self.assertEqual(repo.peek_object_type(
+            "81c545efebe5f57d4cab2ba9ec294c4b0cadf672"), "blob")
+        # gfg-test-dir-1
+        self.assertEqual(repo.peek_object_type(
+            "4414db5a498804bcac80c7d69e4336d5d3b1f959"), "tree")
+        # Non-existing objects don't have a type
+        self.assertTrue(repo.peek_object_type("not-a-git-hash") is None)
+
     def test_get_head_rev(self):
         """ Test the get_head_rev method"""
         head_commit = git_repository.GitRepository.get_repo(".").get_head_rev()